@@ -1,35 +1,318 @@
 import os
-from flask import Flask, request, abort, jsonify, redirect
-from models import setup_db, Therapist, Booking
+import json
+import base64
+from bisect import bisect_left
+from types import SimpleNamespace
+from datetime import datetime, timedelta
+from flask import Flask, request, abort, redirect
+from sqlalchemy import exc
+from models import setup_db, db, is_overlap, Therapist, Booking, BOOKING_DURATION, MAX_BOOKING_LENGTH
 from flask_cors import CORS
-from flask_migrate import Migrate
 
 from auth import AuthError, requires_auth, API_AUDIENCE, AUTH0_DOMAIN
+from cache import LRUCache, cached_listing
+from idempotency import idempotent
+from availability import availability, busy_query
+from instrumentation import setup_instrumentation
+from metrics import setup_metrics, metrics_response, record_auth_error, internal_only, pool_status
+from replicas import setup_replicas
+from serializers import parse_datetime, json_response, rows_to_dicts, stream_response, STREAM_FORMATS
 
 
 ENTRIES_PER_PAGE=10
+MAX_ENTRIES_PER_PAGE=1000
+BOOKINGS_PER_THERAPIST=100
+MAX_AVAILABILITY_WINDOW=timedelta(days=62)
+RESPONSE_CACHE_SIZE=int(os.environ.get('RESPONSE_CACHE_SIZE', 1000))
+MAX_BULK_BOOKINGS=1000
+MAX_BATCH_IDS=100
 CLIENT_ID='AsZwgBsf4Gx4WEcXpRiuZ5rikSa7ePmi'
-
-def paginate(entries,page,entries_per_page):
-  """Paginates all entries returning the right page for a certain entries per page """
-  start =  (page - 1) * entries_per_page
-  end = start + entries_per_page
-  return entries[start:end]
-
-def format_entries(entries):
-  """Formats categories correctly"""
-  return [entry.format() for entry in entries]
-
-def paginate_therapists(request, selection):
-  """paginates a selecation for the right number of pages given by the get request argument """
+# Above this many rows (according to the planner) the totals are estimated instead of counted
+COUNT_ESTIMATE_THRESHOLD=int(os.environ.get('COUNT_ESTIMATE_THRESHOLD', 100000))
+
+# Columns returned by the listings, selected as plain tuples instead of ORM objects
+LIST_COLUMNS = {
+  Therapist: (Therapist.id, Therapist.name),
+  Booking: (Booking.id, Booking.therapist_id, Booking.start_time, Booking.end_time),
+}
+
+# Sort orders of the listings by sort get request argument, as (key columns, descending)
+# The id breaks ties so every order is total. Served by the primary key and ix_Booking_start_time_id
+SORTS = {
+  Therapist: {'id': ((Therapist.id,), False)},
+  Booking: {
+    'id': ((Booking.id,), False),
+    'start_time': ((Booking.start_time, Booking.id), False),
+    '-start_time': ((Booking.start_time, Booking.id), True),
+  },
+}
+
+def list_query(model, filters=(), sort='id'):
+  """Selects the listed columns of the entries of a model matching filters, in a sort order"""
+  columns, descending = SORTS[model][sort]
+  return db.session.query(*LIST_COLUMNS[model]) \
+    .filter(*filters) \
+    .order_by(*[column.desc() if descending else column for column in columns])
+
+def sort_arg(request, model):
+  """Returns the sort get request argument, aborting on unknown sort orders"""
+  sort = request.args.get('sort', 'id')
+  if sort not in SORTS[model]:
+    abort(400)
+  return sort
+
+def booking_filters(request):
+  """Conditions for the therapist_id and from/to (start time) get request arguments, aborting if malformed.
+  Served by ix_Booking_therapist_id_start_time, or ix_Booking_start_time_id without a therapist"""
+  filters = []
+  if 'therapist_id' in request.args:
+    therapist_id = request.args.get('therapist_id', type=int)
+    if therapist_id is None:
+      abort(400)
+    filters.append(Booking.therapist_id == therapist_id)
+  window_start = datetime_arg(request, 'from')
+  if window_start:
+    filters.append(Booking.start_time >= window_start)
+  window_end = datetime_arg(request, 'to')
+  if window_end:
+    filters.append(Booking.start_time < window_end)
+  return filters
+
+def paginate_query(request, model, filters=(), sort='id'):
+  """Fetches and formats only the page given by the get request argument, using LIMIT/OFFSET """
   page = request.args.get('page', 1, type=int)
-  entries = format_entries(selection)
-  return paginate(entries,page,ENTRIES_PER_PAGE)
+  if page < 1:
+    return []
+  entries = list_query(model, filters, sort).limit(ENTRIES_PER_PAGE).offset((page - 1) * ENTRIES_PER_PAGE).all()
+  return rows_to_dicts(entries)
+
+def encode_cursor(entry, sort='id'):
+  """Encodes the position of an entry in a sort order as an opaque cursor"""
+  position = {'id': entry.id}
+  if sort != 'id':
+    position.update(sort=sort, start_time=entry.start_time.isoformat())
+  return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+def decode_cursor(cursor, sort='id'):
+  """Decodes a cursor into the sort key of the last entry seen, aborting on malformed cursors
+  and cursors of another sort order"""
+  try:
+    position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if position.get('sort', 'id') != sort:
+      raise ValueError('cursor of another sort order')
+    after = [position['id']]
+    if sort != 'id':
+      after.insert(0, parse_datetime(position['start_time']))
+  except:
+    abort(400)
+  if not isinstance(after[-1], int):
+    abort(400)
+  return after
+
+def is_cursor_request(request):
+  """Cursor pagination is opt-in through the after or limit get request arguments"""
+  return 'after' in request.args or 'limit' in request.args
+
+def cursor_args(request, sort='id'):
+  """Returns the validated sort key to continue after and the number of entries to return"""
+  limit = request.args.get('limit', ENTRIES_PER_PAGE, type=int)
+  if limit < 1 or limit > MAX_ENTRIES_PER_PAGE:
+    abort(400)
+  after = request.args.get('after')
+  after = decode_cursor(after, sort) if after else None
+  return after, limit
+
+def paginate_cursor(model, after, limit, filters=(), sort='id'):
+  """Fetches and formats the entries following the sort key after (keyset pagination)
+  returns the entries and the cursor of the next page, None on the last page """
+  query = list_query(model, filters, sort)
+  if after is not None:
+    columns, descending = SORTS[model][sort]
+    # A row value comparison, so the database seeks straight to the position in the index
+    key, position = (columns[0], after[0]) if len(columns) == 1 else (db.tuple_(*columns), db.tuple_(*after))
+    query = query.filter(key < position if descending else key > position)
+  entries = query.limit(limit + 1).all()
+  next_cursor = encode_cursor(entries[limit - 1], sort) if len(entries) > limit else None
+  return rows_to_dicts(entries[:limit]), next_cursor
+
+def ids_arg(request):
+  """Returns the distinct ids of the comma separated ids get request argument, None without one.
+  Aborts on malformed ids or more than MAX_BATCH_IDS of them"""
+  ids = request.args.get('ids')
+  if ids is None:
+    return None
+  try:
+    ids = sorted({int(entry_id) for entry_id in ids.split(',') if entry_id.strip()})
+  except ValueError:
+    abort(400)
+  if not ids or len(ids) > MAX_BATCH_IDS:
+    abort(400)
+  return ids
+
+def entries_by_ids(model, ids):
+  """Fetches and formats the entries with the given ids in one query,
+  returns them keyed by id together with the ids that do not exist"""
+  entries = rows_to_dicts(db.session.query(*LIST_COLUMNS[model]).filter(model.id.in_(ids)).all())
+  found = {str(entry['id']): entry for entry in entries}
+  return found, [entry_id for entry_id in ids if str(entry_id) not in found]
+
+def datetime_arg(request, name):
+  """Parses an ISO-8601 get request argument, aborting if malformed"""
+  value = request.args.get(name)
+  if value is None:
+    return None
+  try:
+    return parse_datetime(value)
+  except ValueError:
+    abort(400)
+
+def booking_times(body, start_time, end_time):
+  """Reads the start_time and end_time (or duration in minutes) of a booking from a request body.
+  Missing values default to start_time and end_time, moving the start keeps the length.
+  Raises ValueError if malformed or out of the datetime range"""
+  length = end_time - start_time
+  if body.get('start_time') is not None:
+    start_time = parse_datetime(body['start_time'])
+  try:
+    if body.get('end_time') is not None:
+      end_time = parse_datetime(body['end_time'])
+    elif body.get('duration') is not None:
+      if not isinstance(body['duration'], int):
+        raise ValueError('duration must be an integer')
+      # The start time may be a column computed in SQL, the duration is always known here
+      if not 0 < body['duration'] <= MAX_BOOKING_LENGTH.total_seconds() // 60:
+        raise ValueError('duration must be positive and at most MAX_BOOKING_LENGTH')
+      end_time = start_time + timedelta(minutes=body['duration'])
+    else:
+      end_time = start_time + length
+  except OverflowError:
+    raise ValueError('end_time out of range')
+  # Times computed by SQL are checked by the ck_Booking_end_after_start and
+  # ck_Booking_max_length constraints, whose violations are answered with 422
+  if isinstance(start_time, datetime) and isinstance(end_time, datetime):
+    if end_time <= start_time:
+      raise ValueError('end_time must be after start_time')
+    if end_time - start_time > MAX_BOOKING_LENGTH:
+      raise ValueError('bookings cannot be longer than MAX_BOOKING_LENGTH')
+  return start_time, end_time
+
+def booking_changes(body):
+  """Returns a function giving the columns a PATCH body changes from the current start and end time,
+  which can be the columns themselves so the new times are computed in the UPDATE"""
+  def changes_for(start_time, end_time):
+    changes = {}
+    if 'therapist_id' in body:
+      changes['therapist_id'] = body['therapist_id']
+    if any(body.get(name) is not None for name in ('start_time', 'end_time', 'duration')):
+      changes['start_time'], changes['end_time'] = booking_times(body, start_time, end_time)
+    return changes
+  return changes_for
+
+def if_match_versions(request):
+  """The booking versions accepted by the If-Match header, None if there is none or it is *"""
+  if not request.if_match or request.if_match.star_tag:
+    return None
+  return sorted(int(tag) for tag in request.if_match.as_set() if tag.isdigit())
+
+def booking_response(booking):
+  """A booking with its version as ETag"""
+  response = json_response({
+    'success': True,
+    'id': booking.id,
+    'start_time': booking.start_time,
+    'end_time': booking.end_time,
+    'therapist_id': booking.therapist_id
+  })
+  response.set_etag(str(booking.version))
+  return response
+
+def new_booking_times(body):
+  """Start and end time of a new booking, a session starting now unless the body says otherwise"""
+  now = datetime.utcnow()
+  return booking_times(body, now, now + BOOKING_DURATION)
+
+def booking_overlaps(entries):
+  """Returns, for each new booking entry, None if it can be inserted, 'existing' if it overlaps a booking
+  of its therapist in the table, or the position in entries of an earlier entry it overlaps.
+  The bookings in the table are read with a single query over the span of the batch"""
+  window_start = min(entry['start_time'] for entry in entries)
+  window_end = max(entry['end_time'] for entry in entries)
+  # Per therapist the accepted intervals, sorted by start. They never overlap, so their ends are sorted too
+  taken = {}
+  for therapist_id, start_time, end_time in busy_query(window_start, window_end) \
+      .filter(Booking.therapist_id.in_({entry['therapist_id'] for entry in entries})):
+    starts, ends, owners = taken.setdefault(therapist_id, ([], [], []))
+    starts.append(start_time)
+    ends.append(end_time)
+    owners.append('existing')
+
+  overlaps = []
+  for index, entry in enumerate(entries):
+    starts, ends, owners = taken.setdefault(entry['therapist_id'], ([], [], []))
+    position = bisect_left(starts, entry['end_time'])
+    if position and ends[position - 1] > entry['start_time']:
+      overlaps.append(owners[position - 1])
+      continue
+    starts.insert(position, entry['start_time'])
+    ends.insert(position, entry['end_time'])
+    owners.insert(position, index)
+    overlaps.append(None)
+  return overlaps
+
+def therapist_bookings_query(therapist_id, window_start=None, window_end=None, after=None):
+  """Selects a therapist and its bookings in the window in one query, only the columns we return.
+  after is the (start_time, id) key of the last booking seen, from a cursor of the start_time sort.
+  Served by the ix_Booking_therapist_id_start_time index """
+  booking_filter = [Booking.therapist_id == Therapist.id]
+  if window_start:
+    booking_filter.append(Booking.start_time >= window_start)
+  if window_end:
+    booking_filter.append(Booking.start_time < window_end)
+  if after is not None:
+    booking_filter.append(db.tuple_(Booking.start_time, Booking.id) > db.tuple_(*after))
+  return db.session.query(Therapist.id, Therapist.name, Booking.id.label('booking_id'), Booking.start_time, Booking.end_time) \
+    .outerjoin(Booking, db.and_(*booking_filter)) \
+    .filter(Therapist.id == therapist_id) \
+    .order_by(Booking.start_time, Booking.id)
+
+def window_bookings_query(therapist_id, window_start=None, window_end=None):
+  """Selects the listed columns of the bookings of a therapist in the window, by start time"""
+  query = db.session.query(*LIST_COLUMNS[Booking]).filter(Booking.therapist_id == therapist_id)
+  if window_start:
+    query = query.filter(Booking.start_time >= window_start)
+  if window_end:
+    query = query.filter(Booking.start_time < window_end)
+  return query.order_by(Booking.start_time, Booking.id)
+
+def stream_format(request):
+  """Returns the streaming format asked for by the stream get request argument, None if not streaming"""
+  fmt = request.args.get('stream')
+  if fmt is not None and fmt not in STREAM_FORMATS:
+    abort(400)
+  return fmt
+
+def count_entries(model, filters=()):
+  """Counts the rows of a model matching filters, large unfiltered PostgreSQL tables use the planner estimate instead """
+  if filters:
+    return db.session.query(db.func.count(model.id)).filter(*filters).scalar()
+  if db.engine.dialect.name == 'postgresql':
+    estimate = db.session.execute(
+      db.text('SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:table)'),
+      {'table': '"{}"'.format(model.__tablename__)}).scalar()
+    if estimate is not None and estimate >= COUNT_ESTIMATE_THRESHOLD:
+      return estimate
+  return db.session.query(db.func.count(model.id)).scalar()
 
 def create_app(test_config=None):
 
     app = Flask(__name__)
+    app.config['RESPONSE_CACHE'] = LRUCache(RESPONSE_CACHE_SIZE)
+    if test_config:
+        app.config.update(test_config)
     setup_db(app)
+    setup_replicas(app)
+    setup_instrumentation(app)
+    setup_metrics(app)
 
     CORS(app, resources={r"/*": {"origins": "*"}})
  
@@ -61,66 +344,164 @@ def create_app(test_config=None):
     def loggedout():
         return "Logged in"
 
+    @app.route('/metrics')
+    @internal_only
+    def retrieve_metrics():
+        """ Endpoint exposing request, database pool and auth metrics of all workers for Prometheus """
+        return metrics_response(app)
+
+    @app.route('/metrics/pool')
+    @internal_only
+    def retrieve_pool_metrics():
+        """ Endpoint exposing the utilization and checkout latency of the database connection pool """
+        return json_response({
+            'success': True,
+            'pool': pool_status()
+        })
+
     @app.route('/therapists')
+    @cached_listing('therapists')
     def retrieve_therapists():
         """ Endpoint to handle GET requests for all questions paginated (10 questions) """
+        # A batch of therapists by id
+        ids = ids_arg(request)
+        if ids is not None:
+            try:
+                therapists, missing = entries_by_ids(Therapist, ids)
+            except:
+                abort(422)
+            return json_response({
+                'success': True,
+                'therapists': therapists,
+                'missing': missing
+            })
+
+        # Keyset pagination when a cursor or limit is given
+        if is_cursor_request(request):
+            after, limit = cursor_args(request)
+            try:
+                therapists, next_cursor = paginate_cursor(Therapist, after, limit)
+            except:
+                abort(422)
+            return json_response({
+                'success': True,
+                'therapists': therapists,
+                'next_cursor': next_cursor
+            })
+
+        # Fetch only the requested page of therapists
         try:
-            therapists = Therapist.query.order_by(Therapist.id).all()
+            therapists_paginated = paginate_query(request, Therapist)
+            total_therapists = count_entries(Therapist)
         except:
             abort(422)
-        
-        # Paginate list of therapists and make sure it is a valid page
-        therapists_paginated = paginate_therapists(request, therapists)
+
+        # Make sure it is a valid page
         if not therapists_paginated:
              abort(404)
 
-        return jsonify({
+        return json_response({
             'success': True,
             'therapists': therapists_paginated,
-            'total_therapists': len(therapists)
+            'total_therapists': total_therapists
         })
         
+    @app.route('/therapists/availability')
+    def retrieve_availability():
+        """ Endpoint to handle GET requests for the free slots of all therapists in a time window """
+        window_start = datetime_arg(request, 'from')
+        window_end = datetime_arg(request, 'to')
+        duration = request.args.get('duration', 60, type=int)
+
+        # Make sure we get a bounded window and a sensible duration in minutes
+        if not window_start or not window_end:
+            abort(400)
+        if window_end <= window_start or window_end - window_start > MAX_AVAILABILITY_WINDOW or duration < 1:
+            abort(422)
+
+        try:
+            therapists = availability(window_start, window_end, timedelta(minutes=duration))
+        except:
+            abort(422)
+
+        return json_response({
+            'success': True,
+            'from': window_start,
+            'to': window_end,
+            'duration': duration,
+            'availability': therapists
+        })
+
     @app.route('/therapists/<int:therapist_id>')
     @requires_auth('get:bookings')
     def retrieve_therapist(payload,therapist_id):
-        """ Endpoint to handle GET requests for all questions paginated (10 questions) """
+        """ Endpoint to handle GET requests for a therapist and its bookings, optionally within a time window """
+        window_start = datetime_arg(request, 'from')
+        window_end = datetime_arg(request, 'to')
+
+        # Stream all bookings in the window without a limit
+        fmt = stream_format(request)
+        if fmt:
+            try:
+                therapist = db.session.query(Therapist.id).filter(Therapist.id == therapist_id).first()
+            except:
+                abort(422)
+            if not therapist:
+                abort(404)
+            return stream_response(window_bookings_query(therapist_id, window_start, window_end), fmt)
+
+        limit = request.args.get('limit', BOOKINGS_PER_THERAPIST, type=int)
+        if limit < 1 or limit > MAX_ENTRIES_PER_PAGE:
+            abort(400)
+        after = request.args.get('after')
+        after = decode_cursor(after, 'start_time') if after else None
+
+        # One row more than asked for tells whether there are more bookings
         try:
-            therapist = Therapist.query.get(therapist_id)
+            rows = therapist_bookings_query(therapist_id, window_start, window_end, after).limit(limit + 1).all()
         except:
             abort(422)
-        
-        if not therapist:
+
+        if not rows:
              abort(404)
 
-        return jsonify({
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(SimpleNamespace(id=rows[-1].booking_id, start_time=rows[-1].start_time), 'start_time')
+
+        return json_response({
             'success': True,
-            'name': therapist.name,
-            'id': therapist.id,
-            'bookings': format_entries(therapist.bookings)
+            'name': rows[0].name,
+            'id': rows[0].id,
+            'bookings': [{
+                'id': row.booking_id,
+                'therapist_id': row.id,
+                'start_time': row.start_time,
+                'end_time': row.end_time
+            } for row in rows if row.booking_id is not None],
+            'next_cursor': next_cursor
         })
 
     @app.route('/therapists/<int:therapist_id>', methods=['DELETE'])
     @requires_auth('delete:therapists')
     def delete_therapist(payload,therapist_id):
-        """ Endpoint to DELETE therapist using it's ID. """
+        """ Endpoint to DELETE therapist using it's ID, its bookings are deleted by the database """
         try:
-            therapist = Therapist.query.get(therapist_id)
+            deleted = Therapist.delete_by_id(therapist_id)
         except:
             abort(422)
-        #Make sure the therapist we want to delete exists
-        if not therapist:
+        #Make sure the therapist we want to delete existed
+        if not deleted:
             abort(404)
-        try:
-            therapist.delete()
-        except:
-            abort(422)
-        return jsonify({
+        return json_response({
             'success': True,
             'deleted': therapist_id
         })
 
     @app.route('/therapists', methods=['POST'])
     @requires_auth('post:therapists')
+    @idempotent
     def create_therapist(payload):
         """ Endpoint to POST a new question """
         body = request.get_json()
@@ -134,7 +515,7 @@ def create_app(test_config=None):
         try:
             therapist = Therapist(name=new_name)
             therapist.insert()
-            return jsonify({
+            return json_response({
                 'success': True,
                 'created': therapist.id,
             })
@@ -145,20 +526,56 @@ def create_app(test_config=None):
     @requires_auth('get:bookings')
     def retrieve_bookings(payload):
         """ Endpoint to handle GET requests for all questions paginated (10 questions) """
+        # A batch of bookings by id, with a single auth check and query
+        ids = ids_arg(request)
+        if ids is not None:
+            try:
+                bookings, missing = entries_by_ids(Booking, ids)
+            except:
+                abort(422)
+            return json_response({
+                'success': True,
+                'bookings': bookings,
+                'missing': missing
+            })
+
+        # Filtered and sorted in SQL
+        filters = booking_filters(request)
+        sort = sort_arg(request, Booking)
+
+        # Stream every matching booking
+        fmt = stream_format(request)
+        if fmt:
+            return stream_response(list_query(Booking, filters, sort), fmt)
+
+        # Keyset pagination when a cursor or limit is given
+        if is_cursor_request(request):
+            after, limit = cursor_args(request, sort)
+            try:
+                bookings, next_cursor = paginate_cursor(Booking, after, limit, filters, sort)
+            except:
+                abort(422)
+            return json_response({
+                'success': True,
+                'bookings': bookings,
+                'next_cursor': next_cursor
+            })
+
+        # Fetch only the requested page of bookings
         try:
-            bookings = Booking.query.order_by(Booking.id).all()
+            bookings_paginated = paginate_query(request, Booking, filters, sort)
+            total_bookings = count_entries(Booking, filters)
         except:
             abort(422)
-        
-        # Paginate list of bookings and make sure it is a valid page
-        bookings_paginated = paginate_therapists(request, bookings)
-        if not bookings_paginated:
+
+        # Make sure it is a valid page, filters matching nothing are not an error
+        if not bookings_paginated and (total_bookings or not filters):
              abort(404)
 
-        return jsonify({
+        return json_response({
             'success': True,
             'bookings': bookings_paginated,
-            'total_bookings': len(bookings)
+            'total_bookings': total_bookings
         })
 
     @app.route('/bookings/<int:booking_id>')
@@ -174,15 +591,11 @@ def create_app(test_config=None):
         if not booking:
              abort(404)
 
-        return jsonify({
-            'success': True,
-            'id': booking.id,
-            'start_time': booking.start_time,
-            'therapist_id': booking.therapist_id
-        })
+        return booking_response(booking).make_conditional(request)
 
     @app.route('/bookings', methods=['POST'])
     @requires_auth('post:bookings')
+    @idempotent
     def create_booking(payload):
         """ Endpoint to POST a new booking """
         body = request.get_json()
@@ -192,64 +605,134 @@ def create_app(test_config=None):
             abort(422)
 
         therapist = body.get('therapist_id', None)
+        try:
+            start_time, end_time = new_booking_times(body)
+        except ValueError:
+            abort(422)
 
-        booking = Booking(therapist_id=therapist)
+        booking = Booking(therapist_id=therapist, start_time=start_time, end_time=end_time)
         try:
             booking.insert()
+        except exc.IntegrityError as error:
+            # The therapist is already booked at that time
+            abort(409 if is_overlap(error) else 422)
         except:
             abort(422)
-        return jsonify({
+        return json_response({
             'success': True,
             'created': booking.id,
         })
 
+    @app.route('/bookings/bulk', methods=['POST'])
+    @requires_auth('post:bookings')
+    @idempotent
+    def create_bookings(payload):
+        """ Endpoint to POST an array of new bookings, inserted in a single transaction """
+        body = request.get_json()
+
+        # Check that we are getting a non empty array within the batch size
+        if not isinstance(body, list) or not body or len(body) > MAX_BULK_BOOKINGS:
+            abort(422)
+
+        # Look up all referenced therapists with one query
+        therapist_ids = {item.get('therapist_id') for item in body if isinstance(item, dict)}
+        therapist_ids = [therapist_id for therapist_id in therapist_ids if isinstance(therapist_id, int)]
+        try:
+            existing_ids = {row.id for row in db.session.query(Therapist.id).filter(Therapist.id.in_(therapist_ids))}
+        except:
+            abort(422)
+
+        # Validate every booking, only the valid ones are inserted
+        results = []
+        entries = []
+        for index, item in enumerate(body):
+            result = {'index': index, 'success': False, 'error': 422}
+            results.append(result)
+            if not isinstance(item, dict) or item.get('therapist_id') not in existing_ids:
+                result['message'] = 'Therapist not found'
+                continue
+            try:
+                start_time, end_time = new_booking_times(item)
+            except ValueError:
+                result['message'] = 'Invalid start_time, end_time or duration'
+                continue
+            entry = {'therapist_id': item['therapist_id'], 'start_time': start_time, 'end_time': end_time}
+            entries.append((result, entry))
+
+        # Items overlapping a booking, or an earlier item of the batch, get a 409 result
+        try:
+            overlaps = booking_overlaps([entry for result, entry in entries]) if entries else []
+        except:
+            abort(422)
+        accepted = []
+        for (result, entry), overlap in zip(entries, overlaps):
+            if overlap is None:
+                accepted.append((result, entry))
+            elif overlap == 'existing':
+                result.update({'error': 409, 'message': 'Overlaps an existing booking'})
+            else:
+                result.update({'error': 409, 'message': 'Overlaps item {}'.format(entries[overlap][0]['index'])})
+        entries = accepted
+
+        # A booking made concurrently since the check still rolls back the whole batch
+        try:
+            Booking.bulk_insert([entry for result, entry in entries])
+        except exc.IntegrityError as error:
+            abort(409 if is_overlap(error) else 422)
+        except:
+            abort(422)
+
+        for result, entry in entries:
+            result.update({'success': True, 'created': entry['id']})
+            del result['error']
+        return json_response({
+            'success': True,
+            'created': len(entries),
+            'results': results
+        })
+
     @app.route('/bookings/<int:booking_id>', methods=['PATCH'])
     @requires_auth('patch:bookings')
     def change_booking(payload,booking_id):
-        """ Endpoint to PATCH an existing booking """
+        """ Endpoint to PATCH an existing booking, only if it is still at the version in If-Match when given """
         body = request.get_json()
         
         # Check that we are getting the required fields
         if not (body):
             abort(422)
 
+        versions = if_match_versions(request)
         try:
-            booking = Booking.query.get(booking_id)
+            found, booking = Booking.update_if_match(booking_id, booking_changes(body), versions)
+        except ValueError:
+            abort(422)
+        except exc.IntegrityError as error:
+            abort(409 if is_overlap(error) else 422)
         except:
             abort(422)
 
-        if not (booking):
+        if not found:
             abort(404)
-
-        if 'therapist_id' in body:
-            booking.therapist_id = body.get('therapist_id', None)
-        try:
-            booking.update()
-        except:
-            abort(422)
-        return jsonify({
-            'success': True,
-            'id': booking.id,
-            'start_time': booking.start_time,
-            'therapist_id': booking.therapist_id
-        })
+        # The booking was changed since the client read it
+        if not booking:
+            abort(412 if versions is not None else 409)
+        return booking_response(booking)
   
     @app.route('/bookings/<int:booking_id>', methods=['DELETE'])
     @requires_auth('delete:bookings')
     def delete_booking(payload,booking_id):
-        """ Endpoint to DELETE booking using it's ID. """
+        """ Endpoint to DELETE booking using it's ID, only if it is still at the version in If-Match when given """
+        versions = if_match_versions(request)
         try:
-            booking = Booking.query.get(booking_id)
+            found, deleted = Booking.delete_by_id(booking_id, versions)
         except:
             abort(422)
-        #Make sure the booking we want to delete exists
-        if not booking:
+        #Make sure the booking we want to delete existed, and was not changed since the client read it
+        if not found:
             abort(404)
-        try:
-            booking.delete()
-        except:
-            abort(422)
-        return jsonify({
+        if not deleted:
+            abort(412 if versions is not None else 409)
+        return json_response({
             'success': True,
             'deleted': booking_id
         })
@@ -259,23 +742,47 @@ def create_app(test_config=None):
 
     @app.errorhandler(400)
     def error_bad_request(error):
-        return jsonify({
+        return json_response({
         "success": False,
         "error": 400,
         "message": "Bad Request"
         }), 400
 
+    @app.errorhandler(403)
+    def error_forbidden(error):
+        return json_response({
+        "success": False,
+        "error": 403,
+        "message": "Forbidden"
+        }), 403
+
     @app.errorhandler(404)
     def error_not_found(error):
-        return jsonify({
+        return json_response({
         "success": False,
         "error": 404,
         "message": "Resource Not Found"
         }), 404
 
+    @app.errorhandler(409)
+    def error_conflict(error):
+        return json_response({
+        "success": False,
+        "error": 409,
+        "message": "Conflict"
+        }), 409
+
+    @app.errorhandler(412)
+    def error_precondition_failed(error):
+        return json_response({
+        "success": False,
+        "error": 412,
+        "message": "Precondition Failed"
+        }), 412
+
     @app.errorhandler(422)
     def error_unprocessable(error):
-        return jsonify({
+        return json_response({
         "success": False,
         "error": 422,
         "message": "Unprocessable Entity"
@@ -283,7 +790,8 @@ def create_app(test_config=None):
 
     @app.errorhandler(AuthError)
     def auth_error(error):
-        return jsonify({
+        record_auth_error(error)
+        return json_response({
             "success": False,
             "error": error.status_code,
             "message": error.error['description']
@@ -291,7 +799,13 @@ def create_app(test_config=None):
 
     return app
 
-app = create_app()
+def __getattr__(name):
+  """Builds the module level app on first access (gunicorn app:app, flask run), so
+  importing create_app or the helpers does not build an app nobody uses"""
+  if name == 'app':
+    app = globals()['app'] = create_app()
+    return app
+  raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 if __name__ == '__main__':
-    app.run()
\ No newline at end of file
+    create_app().run()
\ No newline at end of file
@@ -1,13 +1,31 @@
+import hashlib
 import json
+import os
+import threading
+import time
 from flask import request, _request_ctx_stack
 from functools import wraps
 from jose import jwt
+from prometheus_client import Counter
 from urllib.request import urlopen
 
+from cache import LRUCache
+from instrumentation import timing
+
 AUTH0_DOMAIN = 'udacity-segel.eu.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'fsnd-capstone.segelmark.com'
 
+# The JWKS location can be pointed at a local file (file://...) or a stub
+# server for testing, everything else talks to Auth0
+JWKS_URL = os.environ.get('JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+JWKS_TTL = int(os.environ.get('JWKS_TTL', 600))
+JWKS_MIN_REFRESH_INTERVAL = int(os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+JWKS_TIMEOUT = int(os.environ.get('JWKS_TIMEOUT', 5))
+
+# Number of verified tokens kept per worker, each entry is a few hundred bytes
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 10000))
+
 
 # AuthError Exception
 
@@ -20,6 +38,111 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+# JWKS Cache
+
+class JWKSCache:
+    '''JWKSCache
+    Keeps the signing keys published at the JWKS url in memory keyed by kid
+    Keys older than ttl are refreshed in a background thread while the
+    cached keys keep being served
+    An unknown kid triggers an immediate refetch, but at most once every
+    min_refresh_interval seconds so bad tokens cannot hammer Auth0
+    '''
+    def __init__(self, url, ttl=JWKS_TTL, min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.keys = {}
+        self.fetched_at = None
+        self.last_attempt = None
+        self.refreshing = False
+        self.lock = threading.Lock()
+        self.fetch_lock = threading.Lock()
+
+    def fetch(self):
+        """ Downloads the JWKS and returns the RSA keys in it keyed by kid """
+        jsonurl = urlopen(self.url, timeout=JWKS_TIMEOUT)
+        jwks = json.loads(jsonurl.read())
+        return {
+            key['kid']: {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key.get('use', 'sig'),
+                'n': key['n'],
+                'e': key['e']
+            }
+            for key in jwks['keys'] if 'kid' in key
+        }
+
+    def refresh(self):
+        """ Replaces the cached keys, keeping the old ones if the fetch fails """
+        self.last_attempt = time.monotonic()
+        try:
+            keys = self.fetch()
+        except Exception:
+            return False
+        with self.lock:
+            self.keys = keys
+            self.fetched_at = time.monotonic()
+        return True
+
+    def refresh_in_background(self):
+        """ Starts a refresh thread unless one is already running """
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            finally:
+                self.refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def can_refetch(self):
+        """ Rate limits the synchronous refetches """
+        return (self.last_attempt is None or
+                time.monotonic() - self.last_attempt >= self.min_refresh_interval)
+
+    def is_stale(self):
+        return self.fetched_at is None or time.monotonic() - self.fetched_at >= self.ttl
+
+    def get_key(self, kid):
+        """ Returns the key for kid or None if the JWKS does not contain it """
+        if not self.keys:
+            # Concurrent requests wait for the first fetch instead of failing
+            with self.fetch_lock:
+                if not self.keys and self.can_refetch():
+                    self.refresh()
+            if not self.keys:
+                raise AuthError({
+                    'code': 'jwks_unavailable',
+                    'description': 'Unable to fetch the signing keys.'
+                }, 503)
+        elif self.is_stale():
+            self.refresh_in_background()
+
+        key = self.keys.get(kid)
+        if key is None:
+            with self.fetch_lock:
+                key = self.keys.get(kid)
+                if key is None and self.can_refetch():
+                    self.refresh()
+                    key = self.keys.get(kid)
+        return key
+
+
+jwks_cache = JWKSCache(JWKS_URL)
+
+# Verified token payloads keyed by the sha256 of the token, every entry
+# expires together with the token itself
+token_cache = LRUCache(TOKEN_CACHE_SIZE)
+TOKEN_CACHE_HITS = Counter('capstone_token_cache_hits_total', 'Verified token cache hits')
+TOKEN_CACHE_MISSES = Counter('capstone_token_cache_misses_total', 'Verified token cache misses')
+
+
 # Auth Methods
 
 def get_token_auth_header():
@@ -84,30 +207,27 @@ def check_permissions(permission, payload):
 def verify_decode_jwt(token):
     '''token: a json web token (string)
     Checks that is is an Auth0 token with key id (kid)
-    Verifies the token using Auth0 /.well-known/jwks.json
+    Verifies the token using the cached Auth0 /.well-known/jwks.json
     Decodes the payload from the token and validates the claims
+    Tokens that have been verified before are served from the token cache
     return the decoded payload
     '''
 
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    payload = token_cache.get(token_hash)
+    if payload is not None:
+        TOKEN_CACHE_HITS.inc()
+        return payload
+    TOKEN_CACHE_MISSES.inc()
+
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = jwks_cache.get_key(unverified_header['kid'])
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -118,6 +238,8 @@ def verify_decode_jwt(token):
                 issuer='https://' + AUTH0_DOMAIN + '/'
             )
 
+            if 'exp' in payload:
+                token_cache.set(token_hash, payload, payload['exp'])
             return payload
 
         except jwt.ExpiredSignatureError:
@@ -153,7 +275,8 @@ def requires_auth(permission=''):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
+            with timing('auth'):
+                payload = verify_decode_jwt(token)
             check_permissions(permission, payload)
             return f(payload, *args, **kwargs)
         return wrapper
@@ -0,0 +1,53 @@
+from models import db, Therapist, Booking, MAX_BOOKING_LENGTH
+
+
+def free_slots(busy, window_start, window_end, duration):
+  """Returns the gaps of at least duration between the busy intervals within the window.
+  busy is a list of (start, end) tuples sorted by start, overlapping intervals are merged"""
+  slots = []
+  free_from = window_start
+  for start, end in busy:
+    if start - free_from >= duration:
+      slots.append((free_from, min(start, window_end)))
+    free_from = max(free_from, end)
+    if free_from >= window_end:
+      return slots
+  if window_end - free_from >= duration:
+    slots.append((free_from, window_end))
+  return slots
+
+
+def busy_query(window_start, window_end):
+  """Selects the bookings overlapping the window by therapist and start time.
+  On PostgreSQL the range overlap is served by the GiST index of ex_Booking_no_overlap. Elsewhere
+  bookings cannot be longer than MAX_BOOKING_LENGTH, which bounds the start time range to read"""
+  query = db.session.query(Booking.therapist_id, Booking.start_time, Booking.end_time)
+  if db.engine.dialect.name == 'postgresql':
+    query = query.filter(db.func.tsrange(Booking.start_time, Booking.end_time)
+                         .op('&&')(db.func.tsrange(window_start, window_end)))
+  else:
+    query = query.filter(Booking.start_time > window_start - MAX_BOOKING_LENGTH,
+                         Booking.start_time < window_end,
+                         Booking.end_time > window_start)
+  return query.order_by(Booking.therapist_id, Booking.start_time)
+
+
+def busy_intervals(window_start, window_end):
+  """Returns the sorted busy intervals of every therapist overlapping the window, keyed by therapist id.
+  Only the needed columns of the bookings in the window are read"""
+  intervals = {therapist_id: [] for therapist_id, in db.session.query(Therapist.id)}
+  for therapist_id, start_time, end_time in busy_query(window_start, window_end):
+    intervals[therapist_id].append((start_time, end_time))
+  return intervals
+
+
+def availability(window_start, window_end, duration):
+  """Returns the free slots of every therapist with at least one, ordered by therapist id"""
+  return [
+    {
+      'therapist_id': therapist_id,
+      'slots': [{'start': start, 'end': end} for start, end in slots]
+    }
+    for therapist_id, busy in sorted(busy_intervals(window_start, window_end).items())
+    for slots in [free_slots(busy, window_start, window_end, duration)] if slots
+  ]
@@ -0,0 +1,196 @@
+"""Throughput, latency and query count benchmark of every API endpoint
+
+Runs create_app() in-process against a local database seeded with N therapists
+and M bookings, authenticates with tokens signed by a local key whose JWKS is
+served from a local file, and drives each endpoint from concurrent clients.
+Nothing goes over the network. Results are written as JSON so runs on
+different commits can be compared:
+
+    python3 benchmarks/api.py --output before.json
+    git checkout <other commit>
+    python3 benchmarks/api.py --output after.json --compare before.json
+
+DATABASE_URL defaults to a temporary SQLite file.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+workdir = tempfile.mkdtemp(prefix='capstone-bench-')
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(workdir, 'bench.db'))
+os.environ['JWKS_URL'] = 'file://' + os.path.join(workdir, 'jwks.json')
+
+from sqlalchemy import event
+
+from app import create_app
+from models import db, Therapist, Booking
+from fixtures import seed, token, write_jwks
+
+'''
+Endpoints to benchmark: name, method, path and a function building the JSON
+body of the n-th request, None for requests without a body
+'''
+ENDPOINTS = [
+    ('GET /therapists', 'GET', '/therapists', None),
+    ('GET /therapists?limit=100', 'GET', '/therapists?limit=100', None),
+    ('GET /therapists/<id>', 'GET', '/therapists/1', None),
+    ('GET /therapists/availability', 'GET', '/therapists/availability?from=2021-08-02T00:00:00&to=2021-08-09T00:00:00', None),
+    ('GET /bookings', 'GET', '/bookings', None),
+    ('GET /bookings?limit=100', 'GET', '/bookings?limit=100', None),
+    ('GET /bookings?therapist_id&sort', 'GET', '/bookings?therapist_id=1&from=2021-08-02T00:00:00&sort=-start_time&limit=100', None),
+    ('GET /bookings/<id>', 'GET', '/bookings/1', None),
+    ('POST /bookings', 'POST', '/bookings', lambda n: booking_body(n)),
+]
+
+# Bookings created by the benchmark start here and are deleted afterwards
+BENCHMARK_BOOKINGS_START = datetime(2100, 1, 1)
+
+
+def percentile(timings, fraction):
+    return timings[min(len(timings) - 1, int(fraction * len(timings)))] if timings else 0
+
+
+def booking_body(n):
+    """One minute bookings far in the future so they never overlap"""
+    return {
+        'therapist_id': 1,
+        'start_time': (BENCHMARK_BOOKINGS_START + timedelta(minutes=n)).isoformat(),
+        'duration': 1
+    }
+
+
+def run_endpoint(app, counter, method, path, body, requests, concurrency, headers):
+    """Sends requests to one endpoint from concurrency clients"""
+    timings = []
+    queries = []
+    errors = [0]
+    lock = threading.Lock()
+    per_client = max(1, requests // concurrency)
+
+    def client(offset):
+        test_client = app.test_client()
+        local_timings, local_queries, local_errors = [], [], 0
+        for n in range(offset * per_client, (offset + 1) * per_client):
+            counter.count = 0
+            kwargs = {'headers': headers}
+            if body:
+                kwargs['json'] = body(n)
+            start = time.perf_counter()
+            response = test_client.open(path, method=method, **kwargs)
+            response.get_data()
+            local_timings.append(time.perf_counter() - start)
+            local_queries.append(counter.count)
+            if response.status_code >= 400:
+                local_errors += 1
+        with lock:
+            timings.extend(local_timings)
+            queries.extend(local_queries)
+            errors[0] += local_errors
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(offset,)) for offset in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    timings.sort()
+    return {
+        'requests': len(timings),
+        'errors': errors[0],
+        'requests_per_second': round(len(timings) / elapsed, 1),
+        'p50_ms': round(1000 * percentile(timings, 0.50), 3),
+        'p95_ms': round(1000 * percentile(timings, 0.95), 3),
+        'p99_ms': round(1000 * percentile(timings, 0.99), 3),
+        'queries_per_request': round(sum(queries) / len(queries), 2) if queries else 0,
+    }
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """Prints the change of every endpoint against a previous run"""
+    print('\n{:<32} {:>21} {:>25}'.format('compared to ' + str(baseline.get('commit')), 'req/s', 'p95 ms'))
+    for name, result in results['endpoints'].items():
+        before = baseline['endpoints'].get(name)
+        if not before:
+            continue
+        print('{:<32} {:>9.1f} -> {:>9.1f} {:>11.3f} -> {:>11.3f}'.format(
+            name, before['requests_per_second'], result['requests_per_second'], before['p95_ms'], result['p95_ms']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--therapists', type=int, default=100)
+    parser.add_argument('--bookings', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=1000, help='requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--endpoint', action='append', help='only run endpoints starting with this name')
+    parser.add_argument('--output', help='write the results as JSON to this file instead of stdout')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare against')
+    args = parser.parse_args()
+
+    write_jwks(os.environ['JWKS_URL'][len('file://'):])
+    headers = {'Authorization': 'Bearer ' + token()}
+
+    app = create_app()
+    counter = threading.local()
+    with app.app_context():
+        db.create_all()
+        if not Therapist.query.first():
+            seed(args.therapists, args.bookings)
+
+        @event.listens_for(db.engine, 'before_cursor_execute')
+        def count_query(*args):
+            counter.count = getattr(counter, 'count', 0) + 1
+
+    results = {
+        'commit': current_commit(),
+        'database': os.environ['DATABASE_URL'].split(':')[0],
+        'therapists': args.therapists,
+        'bookings': args.bookings,
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'endpoints': {}
+    }
+    for name, method, path, body in ENDPOINTS:
+        if args.endpoint and not any(name.startswith(prefix) for prefix in args.endpoint):
+            continue
+        results['endpoints'][name] = run_endpoint(app, counter, method, path, body, args.requests, args.concurrency, headers)
+        print('{:<32} {:>9.1f} req/s  p50 {:>8.3f}  p95 {:>8.3f}  p99 {:>8.3f} ms  {:>5} queries  {} errors'.format(
+            name, *[results['endpoints'][name][key] for key in
+                    ('requests_per_second', 'p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request', 'errors')]),
+            file=sys.stderr)
+
+    with app.app_context():
+        Booking.query.filter(Booking.start_time >= BENCHMARK_BOOKINGS_START).delete()
+        db.session.commit()
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(results, json.load(baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Shared benchmark fixtures: seed data and local signing keys
+
+seed() fills the database with therapists and non-overlapping bookings.
+write_jwks() writes a local public key as a JWKS file for JWKS_URL=file://...
+and token() mints RS256 tokens the API accepts with it, so no request goes to Auth0
+"""
+import base64
+import json
+import time
+from datetime import datetime, timedelta
+
+import rsa
+from jose import jwt
+
+from auth import API_AUDIENCE, AUTH0_DOMAIN
+from models import db, Therapist, Booking
+
+KID = 'benchmark'
+PERMISSIONS = [
+    'get:bookings', 'post:bookings', 'patch:bookings', 'delete:bookings',
+    'post:therapists', 'delete:therapists'
+]
+
+signing_keys = {}
+
+
+def keys():
+    """The local key pair, generated on first use"""
+    if not signing_keys:
+        public_key, private_key = rsa.newkeys(2048)
+        signing_keys.update(public=public_key, private_pem=private_key.save_pkcs1().decode())
+    return signing_keys
+
+
+def base64url_int(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def write_jwks(path):
+    """Writes the public key as a JWKS file and returns its file:// url"""
+    with open(path, 'w') as jwks_file:
+        json.dump({'keys': [{
+            'kty': 'RSA',
+            'kid': KID,
+            'use': 'sig',
+            'n': base64url_int(keys()['public'].n),
+            'e': base64url_int(keys()['public'].e)
+        }]}, jwks_file)
+    return 'file://' + path
+
+
+def token(permissions=PERMISSIONS, lifetime=3600, subject='benchmark'):
+    """Mints a token signed with the local key"""
+    return jwt.encode({
+        'iss': 'https://' + AUTH0_DOMAIN + '/',
+        'aud': API_AUDIENCE,
+        'sub': subject,
+        'exp': int(time.time()) + lifetime,
+        'permissions': permissions
+    }, keys()['private_pem'], algorithm='RS256', headers={'kid': KID})
+
+
+def seed(therapists, bookings, batch_size=10000):
+    """Creates therapists and bookings spread evenly over them, one hour apart"""
+    db.session.execute(Therapist.__table__.insert(), [
+        {'id': therapist_id, 'name': 'Therapist {}'.format(therapist_id)}
+        for therapist_id in range(1, therapists + 1)
+    ])
+    start = datetime(2021, 8, 2, 9, 0, 0, 123456)
+    for offset in range(0, bookings, batch_size):
+        db.session.execute(Booking.__table__.insert(), [{
+            'id': booking_id + 1,
+            'therapist_id': booking_id % therapists + 1,
+            'start_time': start + timedelta(hours=booking_id // therapists),
+            'end_time': start + timedelta(hours=booking_id // therapists + 1)
+        } for booking_id in range(offset, min(offset + batch_size, bookings))])
+    db.session.commit()
@@ -0,0 +1,60 @@
+"""Compares the old and new serialization of a 10k row bookings payload
+
+ORM objects + format() + jsonify against column tuples + rows_to_dicts + dumps,
+on an in-memory SQLite database so it runs anywhere:
+
+    python3 benchmarks/serialization.py [rows] [repeats]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from flask import jsonify
+
+from app import create_app, list_query
+from models import db, Booking
+from serializers import json_response, rows_to_dicts, orjson
+from fixtures import seed
+
+
+def orm_format_jsonify():
+    bookings = Booking.query.order_by(Booking.id).all()
+    response = jsonify({'success': True, 'bookings': [booking.format() for booking in bookings]})
+    db.session.expunge_all()
+    return response.get_data()
+
+
+def columns_fast_json():
+    bookings = list_query(Booking).all()
+    return json_response({'success': True, 'bookings': rows_to_dicts(bookings)}).get_data()
+
+
+def measure(f, repeats):
+    """Best of repeats, in milliseconds"""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        f()
+        timings.append(time.perf_counter() - start)
+    return 1000 * min(timings)
+
+
+def main(rows=10000, repeats=5):
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        seed(rows // 100 + 1, rows)
+        baseline = measure(orm_format_jsonify, repeats)
+        fast = measure(columns_fast_json, repeats)
+    backend = 'orjson' if orjson is not None else 'json'
+    print('rows: {}'.format(rows))
+    print('ORM objects + format() + jsonify: {:8.1f} ms'.format(baseline))
+    print('column tuples + {:<6} dumps:      {:8.1f} ms'.format(backend, fast))
+    print('speedup: {:.1f}x'.format(baseline / fast))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,151 @@
+"""Requests/sec of the gunicorn worker profiles on the same machine
+
+Starts gunicorn with gunicorn.conf.py once per WORKER_PROFILE against the same
+database and drives authenticated GET endpoints from concurrent keep-alive
+clients. Tokens are signed by a local key and the JWKS is read from a local
+file, so nothing goes over the network:
+
+    python3 benchmarks/workers.py [--duration 10] [--concurrency 32] [sync gthread gevent]
+
+DATABASE_URL defaults to a temporary SQLite file; point it at PostgreSQL to see
+the effect of database latency on the sync workers.
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+workdir = tempfile.mkdtemp(prefix='capstone-bench-')
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(workdir, 'bench.db'))
+
+from app import create_app
+from models import db, Therapist
+from fixtures import seed, token, write_jwks
+
+PATHS = ['/bookings', '/therapists/1', '/bookings/1', '/therapists?limit=50']
+
+
+def percentile(timings, fraction):
+    return timings[min(len(timings) - 1, int(fraction * len(timings)))] if timings else 0
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('gunicorn did not start on port {}'.format(port))
+
+
+def drive(port, headers, duration, concurrency):
+    """Sends requests from concurrency keep-alive clients for duration seconds"""
+    timings = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def client(offset):
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        local_timings = []
+        local_errors = 0
+        request_number = offset
+        while time.time() < deadline:
+            path = PATHS[request_number % len(PATHS)]
+            request_number += 1
+            start = time.perf_counter()
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    local_errors += 1
+            except (OSError, http.client.HTTPException):
+                local_errors += 1
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                continue
+            local_timings.append(time.perf_counter() - start)
+        connection.close()
+        with lock:
+            timings.extend(local_timings)
+            errors[0] += local_errors
+
+    started = time.time()
+    threads = [threading.Thread(target=client, args=(offset,)) for offset in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    timings.sort()
+    return {
+        'requests': len(timings),
+        'errors': errors[0],
+        'requests_per_second': round(len(timings) / elapsed, 1),
+        'p50_ms': round(1000 * percentile(timings, 0.50), 2),
+        'p99_ms': round(1000 * percentile(timings, 0.99), 2),
+    }
+
+
+def run_profile(profile, port, env, args, headers):
+    env = dict(env, WORKER_PROFILE=profile, PORT=str(port), WEB_CONCURRENCY=str(args.workers))
+    server = subprocess.Popen(
+        [sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()', '-c', 'gunicorn.conf.py', 'app:app'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        # Warm up the JWKS and token caches of every worker
+        drive(port, headers, 1, args.concurrency)
+        return drive(port, headers, args.duration, args.concurrency)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('profiles', nargs='*', default=['sync', 'gthread', 'gevent'])
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--therapists', type=int, default=100)
+    parser.add_argument('--bookings', type=int, default=10000)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        if not Therapist.query.first():
+            seed(args.therapists, args.bookings)
+
+    env = dict(os.environ, JWKS_URL=write_jwks(os.path.join(workdir, 'jwks.json')))
+    headers = {'Authorization': 'Bearer ' + token()}
+
+    results = {}
+    for profile in args.profiles:
+        results[profile] = run_profile(profile, args.port, env, args, headers)
+        result = results[profile]
+        print('{:<8} {:>9.1f} req/s  p50 {:>7.2f} ms  p99 {:>7.2f} ms  errors {}'.format(
+            profile, result['requests_per_second'], result['p50_ms'], result['p99_ms'], result['errors']))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'concurrency': args.concurrency, 'workers': args.workers, 'results': results}, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
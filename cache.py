@@ -0,0 +1,95 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, request
+
+from models import ListingVersion
+
+
+class LRUCache:
+    '''LRUCache
+    A bounded, thread safe least recently used cache
+    Every entry can carry its own absolute expiry time (time.time() based)
+    Keeps hit and miss counters so the cache can be monitored
+    '''
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """ Returns the value for key, or default if it is missing or expired """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > time.time():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, expires_at=None):
+        """ Stores value under key, evicting the least recently used entry when full """
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """ Returns the size of the cache and its hit/miss counters """
+        return {
+            'size': len(self.entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+def cached_listing(name):
+    '''cached_listing(name)
+    Caches the JSON responses of a listing endpoint per query string
+    Entries are keyed by the ListingVersion of the listing, so a committed
+    write in any worker makes every cached response stale
+    Responses carry ETag/Last-Modified and conditional requests get a 304
+    The backend is app.config['RESPONSE_CACHE'], anything with get and set
+    '''
+    def cached_listing_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            version, updated_at = ListingVersion.current(name)
+            query_hash = hashlib.sha1(request.query_string).hexdigest()[:16]
+            etag = '{}-{}-{}'.format(name, version, query_hash)
+
+            response_cache = current_app.config['RESPONSE_CACHE']
+            body = response_cache.get(etag)
+            if body is None:
+                response = f(*args, **kwargs)
+                if response.status_code != 200:
+                    return response
+                body = response.get_data()
+                response_cache.set(etag, body)
+
+            response = current_app.response_class(body, mimetype='application/json')
+            response.set_etag(etag)
+            if updated_at:
+                response.last_modified = updated_at
+            response.cache_control.no_cache = True
+            return response.make_conditional(request)
+        return wrapper
+    return cached_listing_decorator
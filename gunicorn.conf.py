@@ -0,0 +1,52 @@
+import os
+import re
+
+'''
+Worker profiles
+    sync    - one request at a time per worker process (the original setup)
+    gthread - a pool of threads per worker, for I/O bound requests
+    gevent  - greenlets per worker, with the standard library and psycopg2
+              patched to yield while waiting on Auth0 or the database
+Selected with WORKER_PROFILE, the sizes can be tuned with the variables below
+'''
+WORKER_PROFILE = os.environ.get('WORKER_PROFILE', 'sync')
+
+bind = '0.0.0.0:' + os.environ.get('PORT', '8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = WORKER_PROFILE
+threads = int(os.environ.get('GUNICORN_THREADS', 8)) if WORKER_PROFILE == 'gthread' else 1
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 100))
+keepalive = 5
+
+# Let setup_db pick connection pool defaults for the worker class
+os.environ['GUNICORN_WORKER_CLASS'] = worker_class
+os.environ['GUNICORN_THREADS'] = str(threads)
+
+
+# The files prometheus_client writes per process, e.g. counter_1234.db or gauge_livesum_1234.db
+METRICS_FILE = re.compile(r'^(counter|histogram|summary|gauge_[a-z]+)_\d+\.db$')
+
+
+def on_starting(server):
+    # Metrics files of a previous run would be added to the new counts.
+    # Only those are removed, in case the directory is shared with other files
+    metrics_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if metrics_dir:
+        os.makedirs(metrics_dir, exist_ok=True)
+        for name in os.listdir(metrics_dir):
+            path = os.path.join(metrics_dir, name)
+            if METRICS_FILE.match(name) and os.path.isfile(path):
+                os.remove(path)
+
+
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def post_fork(server, worker):
+    # Make psycopg2 cooperative so a query only blocks its own greenlet
+    if WORKER_PROFILE == 'gevent' and os.environ.get('DATABASE_URL', '').startswith('postgres'):
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
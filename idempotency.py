@@ -0,0 +1,72 @@
+import hashlib
+import os
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import abort, current_app, make_response, request
+
+from models import IdempotencyKey
+
+# Keys are kept for this many hours, see manage.py prune_idempotency_keys
+IDEMPOTENCY_KEY_TTL = timedelta(hours=int(os.environ.get('IDEMPOTENCY_KEY_TTL_HOURS', 24)))
+# A claim still pending after this many seconds belongs to a request that died and can be taken over
+IDEMPOTENCY_PENDING_TIMEOUT = timedelta(seconds=int(os.environ.get('IDEMPOTENCY_PENDING_TIMEOUT', 60)))
+MAX_KEY_LENGTH = 255
+
+
+def sha256(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else part.encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def idempotent(f):
+    '''idempotent
+    Makes a POST endpoint safe to retry with an Idempotency-Key header
+    The key is scoped to the caller (the token sub) and the path. The first
+    request claims it by inserting a pending row, whose primary key lets only
+    one request in any worker win. Its response is stored and replayed to
+    retries without running the endpoint again. A retry while the first
+    request is still running gets a 409, reusing a key for a different body
+    a 422. Failed requests (exceptions, aborts, 5xx) release the key, keys
+    older than IDEMPOTENCY_KEY_TTL and claims pending for longer than
+    IDEMPOTENCY_PENDING_TIMEOUT are claimed anew
+    Wrapped by requires_auth, so it receives the payload
+    '''
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key is None:
+            return f(payload, *args, **kwargs)
+        if not idempotency_key or len(idempotency_key) > MAX_KEY_LENGTH:
+            abort(400)
+
+        key = sha256(payload.get('sub', ''), request.path, idempotency_key)
+        request_hash = sha256(request.method, request.get_data())
+        claimed_at, stored = IdempotencyKey.claim(key, request_hash, IDEMPOTENCY_KEY_TTL, IDEMPOTENCY_PENDING_TIMEOUT)
+        if stored is not None:
+            if stored.request_hash != request_hash:
+                abort(422)
+            if stored.status_code is None:
+                abort(409)
+            response = current_app.response_class(stored.body, status=stored.status_code, mimetype='application/json')
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            response = make_response(f(payload, *args, **kwargs))
+        except BaseException:
+            IdempotencyKey.release(key, claimed_at)
+            raise
+        if response.status_code >= 500:
+            IdempotencyKey.release(key, claimed_at)
+        else:
+            IdempotencyKey.complete(key, claimed_at, response.status_code, response.get_data())
+        return response
+    return wrapper
+
+
+def prune_keys(ttl=IDEMPOTENCY_KEY_TTL):
+    '''Deletes the keys older than ttl, returning how many'''
+    return IdempotencyKey.prune(datetime.utcnow() - ttl)
@@ -0,0 +1,85 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+from flask import g, request, has_request_context
+from sqlalchemy import event
+
+from models import db
+
+INSTRUMENTATION = os.environ.get('INSTRUMENTATION', 'false').lower() == 'true'
+# Requests slower than this many milliseconds are logged, 0 disables the log
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 0))
+
+logger = logging.getLogger('capstone.requests')
+
+
+@contextmanager
+def timing(name):
+    """ Adds the duration of the block to the timing called name of the current request.
+    Only requests of apps set up with setup_instrumentation have timings, elsewhere it does nothing """
+    if not has_request_context() or 'timings' not in g:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        g.timings[name] += time.perf_counter() - start
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    if has_request_context() and 'timings' in g:
+        g.timings['db'] += elapsed
+        g.queries += 1
+
+
+def instrument_engine(engine):
+    """ Times every query sent through engine """
+    if not event.contains(engine, 'before_cursor_execute', before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+
+def start_request():
+    g.request_start = time.perf_counter()
+    g.queries = 0
+    g.timings = {'db': 0.0, 'auth': 0.0, 'serialize': 0.0}
+
+
+def finish_request(response):
+    """ Adds the Server-Timing header and logs slow requests """
+    if 'timings' not in g:
+        return response
+    total = 1000 * (time.perf_counter() - g.request_start)
+    db_ms, auth_ms, serialize_ms = [1000 * g.timings[name] for name in ('db', 'auth', 'serialize')]
+    response.headers['Server-Timing'] = \
+        'db;dur={:.2f};desc="{} queries", auth;dur={:.2f}, serialize;dur={:.2f}, total;dur={:.2f}'.format(
+            db_ms, g.queries, auth_ms, serialize_ms, total)
+    if SLOW_REQUEST_MS and total >= SLOW_REQUEST_MS:
+        logger.warning('slow request %s %s %s: %.1fms, %d queries in %.1fms, auth %.1fms, serialize %.1fms',
+                       request.method, request.full_path, response.status_code,
+                       total, g.queries, db_ms, auth_ms, serialize_ms)
+    return response
+
+
+def setup_instrumentation(app):
+    ''' Records per request query count and time, JWT verification time and
+    serialization time, exposed as a Server-Timing header and a slow request log
+    Nothing is hooked unless INSTRUMENTATION is enabled, so it costs nothing when disabled
+    JWT verification and serialization are timed at their call sites (see timing),
+    which only record for requests of this app
+    '''
+    if not app.config.get('INSTRUMENTATION', INSTRUMENTATION):
+        return
+    instrument_engine(db.get_engine(app))
+    if 'replicas' in app.extensions:
+        for engine in app.extensions['replicas'].engines:
+            instrument_engine(engine)
+    app.before_request(start_request)
+    app.after_request(finish_request)
@@ -1,14 +1,63 @@
+import sys
+from datetime import timedelta
+
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
-from app import app
+from app import create_app
 from models import db
+from transfer import TABLES, FORMATS, export_rows, import_rows
+from idempotency import IDEMPOTENCY_KEY_TTL, prune_keys
+
+migrate = Migrate(db=db)
+
 
-migrate = Migrate(app, db)
-manager = Manager(app)
+def make_app():
+    """The app is only built once a command runs, with migrations registered on it"""
+    app = create_app()
+    migrate.init_app(app)
+    return app
+
+
+manager = Manager(make_app)
 
 manager.add_command('db', MigrateCommand)
 
 
+@manager.option('table', choices=list(TABLES))
+@manager.option('-f', '--format', dest='fmt', choices=FORMATS, default='ndjson')
+@manager.option('-o', '--output', dest='output', default=None, help='File to write to, stdout by default')
+def dump(table, fmt, output):
+    """Streams all therapists or bookings as NDJSON or CSV"""
+    out = open(output, 'w', newline='') if output else sys.stdout
+    try:
+        count = export_rows(table, out, fmt)
+    finally:
+        if output:
+            out.close()
+    print('Exported {} {}'.format(count, table), file=sys.stderr)
+
+
+@manager.option('table', choices=list(TABLES))
+@manager.option('-f', '--format', dest='fmt', choices=FORMATS, default='ndjson')
+@manager.option('-i', '--input', dest='input', default=None, help='File to read from, stdin by default')
+def load(table, fmt, input):
+    """Loads therapists or bookings from NDJSON or CSV in batches"""
+    infile = open(input, newline='') if input else sys.stdin
+    try:
+        count = import_rows(table, infile, fmt)
+    finally:
+        if input:
+            infile.close()
+    print('Imported {} {}'.format(count, table), file=sys.stderr)
+
+
+@manager.option('--hours', dest='hours', type=int, default=None, help='Age of the keys to delete, IDEMPOTENCY_KEY_TTL_HOURS by default')
+def prune_idempotency_keys(hours):
+    """Deletes stored Idempotency-Key responses older than their TTL"""
+    ttl = timedelta(hours=hours) if hours is not None else IDEMPOTENCY_KEY_TTL
+    print('Pruned {} idempotency keys'.format(prune_keys(ttl)), file=sys.stderr)
+
+
 if __name__ == '__main__':
-    manager.run()
\ No newline at end of file
+    manager.run()
@@ -0,0 +1,207 @@
+import hmac
+import ipaddress
+import os
+import threading
+import time
+from functools import wraps
+from flask import abort, g, request
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry,
+                               Counter, Gauge, Histogram, generate_latest, multiprocess)
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+from auth import jwks_cache
+from models import db
+
+'''
+Prometheus metrics
+    With PROMETHEUS_MULTIPROC_DIR set (see gunicorn.conf.py) every gunicorn
+    worker writes its samples to its own memory mapped files and /metrics
+    aggregates the files of all workers, so workers never wait on each other.
+    Counters are incremented where their events happen (pool checkouts
+    below, token cache lookups in auth.py) and keep the totals of exited
+    workers. Gauges describing the state of a worker are updated at the end
+    of each of its requests and summed over the live workers.
+'''
+MULTIPROCESS = 'PROMETHEUS_MULTIPROC_DIR' in os.environ
+# Networks allowed to read the metrics endpoints, they are not meant for API clients.
+# Only loopback by default: behind a router (Heroku) every client has a private address
+METRICS_ALLOWED_NETWORKS = [ipaddress.ip_network(network.strip()) for network in os.environ.get(
+    'METRICS_ALLOWED_NETWORKS', '127.0.0.0/8,::1/128').split(',') if network.strip()]
+# Scrapers elsewhere send this shared token as a bearer token, unset disables it
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+REQUESTS = Counter('capstone_http_requests_total', 'HTTP requests', ['method', 'route', 'status'])
+REQUEST_LATENCY = Histogram(
+    'capstone_http_request_duration_seconds', 'HTTP request latency', ['method', 'route', 'status'],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+AUTH_ERRORS = Counter('capstone_auth_errors_total', 'Authentication and authorization failures', ['code'])
+
+POOL_SIZE = Gauge('capstone_db_pool_size', 'Connections kept in the pools', multiprocess_mode='livesum')
+POOL_CHECKED_OUT = Gauge('capstone_db_pool_checked_out', 'Connections in use', multiprocess_mode='livesum')
+POOL_OVERFLOW = Gauge('capstone_db_pool_overflow', 'Connections opened above the pool size', multiprocess_mode='livesum')
+
+JWKS_KEYS = Gauge('capstone_jwks_keys', 'Signing keys in the JWKS cache', multiprocess_mode='min')
+JWKS_FETCHED = Gauge('capstone_jwks_last_fetch_timestamp_seconds', 'Oldest successful JWKS fetch of a worker', multiprocess_mode='min')
+
+
+'''
+PoolMetrics
+    checkout latency and timeouts of the connection pools of this process,
+    updated by the threads of concurrent requests under a lock
+'''
+# Only ever increase, so they are exported as counters that keep their totals across worker restarts
+POOL_CHECKOUTS = Counter('capstone_db_pool_checkouts_total', 'Connection checkouts')
+POOL_CHECKOUT_WAIT = Counter('capstone_db_pool_checkout_wait_seconds_total', 'Time spent waiting for connections')
+POOL_TIMEOUTS = Counter('capstone_db_pool_timeouts_total', 'Checkouts that timed out')
+
+class PoolMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def observe(self, wait):
+        with self.lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+        POOL_CHECKOUTS.inc()
+        POOL_CHECKOUT_WAIT.inc(wait)
+
+    def timed_out(self):
+        with self.lock:
+            self.timeouts += 1
+        POOL_TIMEOUTS.inc()
+
+    def snapshot(self):
+        '''the counters read together, so the average wait matches the checkout count'''
+        with self.lock:
+            return self.checkouts, self.timeouts, self.wait_total, self.wait_max
+
+pool_metrics = PoolMetrics()
+
+
+'''
+InstrumentedQueuePool
+        a QueuePool timing every checkout through its public checkout methods, as
+        SQLAlchemy has no pool event before a checkout starts waiting
+        max_overflow is kept so the pool capacity can be reported
+'''
+class InstrumentedQueuePool(QueuePool):
+    def __init__(self, creator, max_overflow=10, **kw):
+        super().__init__(creator, max_overflow=max_overflow, **kw)
+        self.max_overflow = max_overflow
+
+    def timed_checkout(self, checkout):
+        start = time.perf_counter()
+        try:
+            return checkout()
+        except exc.TimeoutError:
+            pool_metrics.timed_out()
+            raise
+        finally:
+            pool_metrics.observe(time.perf_counter() - start)
+
+    # Sessions check out through connect(), Engine.connect() through unique_connection()
+    def connect(self):
+        return self.timed_checkout(super().connect)
+
+    def unique_connection(self):
+        return self.timed_checkout(super().unique_connection)
+
+
+'''
+pool_status()
+    utilization and checkout latency of the connection pool
+'''
+def pool_status():
+    pool = db.engine.pool
+    checkouts, timeouts, wait_total, wait_max = pool_metrics.snapshot()
+    status = {
+        'checkouts': checkouts,
+        'timeouts': timeouts,
+        'checkout_wait_avg_ms': round(1000 * wait_total / checkouts, 3) if checkouts else 0,
+        'checkout_wait_max_ms': round(1000 * wait_max, 3),
+    }
+    if isinstance(pool, InstrumentedQueuePool):
+        capacity = pool.size() + max(pool.max_overflow, 0)
+        status.update({
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow(),
+            'saturation': round(pool.checkedout() / capacity, 3) if capacity else 0,
+        })
+    return status
+
+
+def record_auth_error(error):
+    AUTH_ERRORS.labels(code=error.error['code']).inc()
+
+
+def start_timer():
+    g.metrics_start = time.perf_counter()
+
+
+def record_request(response):
+    """ Counts the request by route template, so ids do not create new series """
+    if 'metrics_start' not in g:
+        return response
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    labels = (request.method, route, response.status_code)
+    REQUESTS.labels(*labels).inc()
+    REQUEST_LATENCY.labels(*labels).observe(time.perf_counter() - g.metrics_start)
+    update_state()
+    return response
+
+
+def update_state():
+    """ Updates the gauges of this worker """
+    pool = db.engine.pool
+    if isinstance(pool, QueuePool):
+        POOL_SIZE.set(pool.size())
+        POOL_CHECKED_OUT.set(pool.checkedout())
+        POOL_OVERFLOW.set(max(pool.overflow(), 0))
+    JWKS_KEYS.set(len(jwks_cache.keys))
+    if jwks_cache.fetched_at is not None:
+        JWKS_FETCHED.set(time.time() - (time.monotonic() - jwks_cache.fetched_at))
+
+
+def metrics_allowed():
+    """ Whether the request carries METRICS_TOKEN or comes from METRICS_ALLOWED_NETWORKS """
+    if METRICS_TOKEN:
+        scheme, _, credentials = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() == 'bearer' and hmac.compare_digest(credentials.encode(), METRICS_TOKEN.encode()):
+            return True
+    try:
+        address = ipaddress.ip_address(request.remote_addr)
+    except ValueError:
+        return False
+    return any(address in network for network in METRICS_ALLOWED_NETWORKS)
+
+
+def internal_only(f):
+    """ Rejects requests with neither METRICS_TOKEN nor an address in METRICS_ALLOWED_NETWORKS with 403 """
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if not metrics_allowed():
+            abort(403)
+        return f(*args, **kwargs)
+    return wrapper
+
+
+def metrics_response(app):
+    """ The metrics of all workers in the Prometheus text format """
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return app.response_class(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def setup_metrics(app):
+    app.before_request(start_timer)
+    app.after_request(record_request)
@@ -0,0 +1,53 @@
+"""booking end times and non-overlap constraint
+
+Revision ID: 2d8a6f4c0e13
+Revises: 9c3e5a7f1b20
+Create Date: 2026-10-18 13:05:22.904716
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2d8a6f4c0e13'
+down_revision = '9c3e5a7f1b20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Bookings of a therapist sharing a start time cannot be given an end time
+    # that keeps them apart, they have to be resolved by hand before upgrading
+    conflicts = op.get_bind().execute(sa.text("""
+        SELECT therapist_id, start_time, string_agg(id::text, ', ' ORDER BY id) AS ids
+        FROM "Booking" GROUP BY therapist_id, start_time HAVING count(*) > 1
+    """)).fetchall()
+    if conflicts:
+        raise RuntimeError('Bookings share a start time, delete or move all but one of each group:\n' + '\n'.join(
+            'therapist {} at {}: bookings {}'.format(row.therapist_id, row.start_time, row.ids) for row in conflicts))
+
+    op.add_column('Booking', sa.Column('end_time', sa.DateTime(), nullable=True))
+    # Existing bookings last one session, cut short where the next booking of
+    # the same therapist starts earlier so the exclusion constraint holds
+    op.execute("""
+        UPDATE "Booking" SET end_time = LEAST("Booking".start_time + interval '60 minutes', next.next_start)
+        FROM (
+            SELECT id, LEAD(start_time) OVER (PARTITION BY therapist_id ORDER BY start_time, id) AS next_start
+            FROM "Booking"
+        ) AS next
+        WHERE next.id = "Booking".id
+    """)
+    op.alter_column('Booking', 'end_time', nullable=False)
+    # Existing rows are validated too, conflicts were rejected above
+    op.execute('ALTER TABLE "Booking" ADD CONSTRAINT "ck_Booking_end_after_start" CHECK (end_time > start_time) NOT VALID')
+    op.execute('ALTER TABLE "Booking" VALIDATE CONSTRAINT "ck_Booking_end_after_start"')
+    op.execute('CREATE EXTENSION IF NOT EXISTS btree_gist')
+    op.execute('ALTER TABLE "Booking" ADD CONSTRAINT "ex_Booking_no_overlap" '
+               'EXCLUDE USING gist (therapist_id WITH =, tsrange(start_time, end_time) WITH &&)')
+
+
+def downgrade():
+    op.drop_constraint('ex_Booking_no_overlap', 'Booking')
+    op.drop_constraint('ck_Booking_end_after_start', 'Booking')
+    op.drop_column('Booking', 'end_time')
@@ -0,0 +1,24 @@
+"""index bookings by start time for sorted listings
+
+Revision ID: 3c7e9a1d5b08
+Revises: 8a4d6c2e9f31
+Create Date: 2026-10-18 22:03:18.552960
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c7e9a1d5b08'
+down_revision = '8a4d6c2e9f31'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_Booking_start_time_id', 'Booking', ['start_time', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_Booking_start_time_id', table_name='Booking')
@@ -0,0 +1,24 @@
+"""index bookings by therapist and start time
+
+Revision ID: 4b1f0c9d2e7a
+Revises: 27ef562e8b60
+Create Date: 2026-10-18 10:12:41.203114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b1f0c9d2e7a'
+down_revision = '27ef562e8b60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_Booking_therapist_id_start_time', 'Booking', ['therapist_id', 'start_time'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_Booking_therapist_id_start_time', table_name='Booking')
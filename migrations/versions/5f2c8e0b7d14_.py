@@ -0,0 +1,26 @@
+"""delete bookings with their therapist in the database
+
+Revision ID: 5f2c8e0b7d14
+Revises: 7e1b4d9a3c52
+Create Date: 2026-10-18 21:20:13.640271
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f2c8e0b7d14'
+down_revision = '7e1b4d9a3c52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.drop_constraint('Booking_therapist_id_fkey', 'Booking', type_='foreignkey')
+    op.create_foreign_key('Booking_therapist_id_fkey', 'Booking', 'Therapist', ['therapist_id'], ['id'], ondelete='CASCADE')
+
+
+def downgrade():
+    op.drop_constraint('Booking_therapist_id_fkey', 'Booking', type_='foreignkey')
+    op.create_foreign_key('Booking_therapist_id_fkey', 'Booking', 'Therapist', ['therapist_id'], ['id'])
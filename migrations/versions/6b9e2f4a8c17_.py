@@ -0,0 +1,35 @@
+"""bound the length of bookings
+
+Revision ID: 6b9e2f4a8c17
+Revises: 3c7e9a1d5b08
+Create Date: 2026-10-19 09:12:40.318275
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6b9e2f4a8c17'
+down_revision = '3c7e9a1d5b08'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Bookings already longer than the limit have to be shortened or deleted by hand
+    too_long = op.get_bind().execute(sa.text("""
+        SELECT id, start_time, end_time FROM "Booking"
+        WHERE end_time - start_time > interval '24 hours' ORDER BY id
+    """)).fetchall()
+    if too_long:
+        raise RuntimeError('Bookings are longer than 24 hours, shorten or delete them:\n' + '\n'.join(
+            'booking {}: {} to {}'.format(row.id, row.start_time, row.end_time) for row in too_long))
+
+    op.execute('ALTER TABLE "Booking" ADD CONSTRAINT "ck_Booking_max_length" '
+               "CHECK (end_time - start_time <= interval '24 hours') NOT VALID")
+    op.execute('ALTER TABLE "Booking" VALIDATE CONSTRAINT "ck_Booking_max_length"')
+
+
+def downgrade():
+    op.drop_constraint('ck_Booking_max_length', 'Booking')
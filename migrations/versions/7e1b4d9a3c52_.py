@@ -0,0 +1,33 @@
+"""idempotency keys for POST retries
+
+Revision ID: 7e1b4d9a3c52
+Revises: 2d8a6f4c0e13
+Create Date: 2026-10-18 21:02:41.318604
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7e1b4d9a3c52'
+down_revision = '2d8a6f4c0e13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('IdempotencyKey',
+    sa.Column('key', sa.String(length=64), nullable=False),
+    sa.Column('request_hash', sa.String(length=64), nullable=False),
+    sa.Column('status_code', sa.Integer(), nullable=True),
+    sa.Column('body', sa.LargeBinary(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('key')
+    )
+    op.create_index(op.f('ix_IdempotencyKey_created_at'), 'IdempotencyKey', ['created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_IdempotencyKey_created_at'), table_name='IdempotencyKey')
+    op.drop_table('IdempotencyKey')
@@ -0,0 +1,25 @@
+"""booking versions for optimistic concurrency
+
+Revision ID: 8a4d6c2e9f31
+Revises: 5f2c8e0b7d14
+Create Date: 2026-10-18 21:41:57.104823
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4d6c2e9f31'
+down_revision = '5f2c8e0b7d14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # A constant default does not rewrite the table on PostgreSQL 11+
+    op.add_column('Booking', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('Booking', 'version')
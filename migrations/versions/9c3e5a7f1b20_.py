@@ -0,0 +1,30 @@
+"""listing versions for response cache invalidation
+
+Revision ID: 9c3e5a7f1b20
+Revises: 4b1f0c9d2e7a
+Create Date: 2026-10-18 11:40:05.517362
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c3e5a7f1b20'
+down_revision = '4b1f0c9d2e7a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('ListingVersion',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.execute("INSERT INTO \"ListingVersion\" (name, version, updated_at) VALUES ('therapists', 0, now())")
+
+
+def downgrade():
+    op.drop_table('ListingVersion')
@@ -1,24 +1,112 @@
-from sqlalchemy import Column, String, create_engine
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
-from datetime import datetime
+from sqlalchemy import DDL, Column, String, create_engine, event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from datetime import datetime, timedelta
 import json
 import os
+import sqlite3
 
-database_path = os.environ['DATABASE_URL']
+from replicas import ReplicaSet, RoutingQuery, RoutingSQLAlchemy, replica_urls
+
+# Bookings last one session of this length unless given an end time
+BOOKING_DURATION = timedelta(minutes=60)
+# and never longer than this, so bookings overlapping a time window start shortly before it
+MAX_BOOKING_LENGTH = timedelta(hours=24)
+
+# SQLSTATE of PostgreSQL exclusion constraint violations
+EXCLUSION_VIOLATION = '23P01'
+
+
+db = RoutingSQLAlchemy(query_class=RoutingQuery)
+
+'''
+Connection pool defaults per gunicorn worker class
+A sync worker serves one request at a time, threaded and async workers
+need a connection per request they serve concurrently
+'''
+POOL_DEFAULTS = {
+  'sync': {'pool_size': 2, 'max_overflow': 2},
+  'gthread': {'pool_size': int(os.environ.get('GUNICORN_THREADS', 4)), 'max_overflow': 4},
+  'gevent': {'pool_size': 10, 'max_overflow': 20},
+  'eventlet': {'pool_size': 10, 'max_overflow': 20},
+}
+
+
+'''
+engine_options(database_path)
+    connection pool configuration taken from the environment
+'''
+def engine_options(database_path):
+    # SQLite does not use a QueuePool
+    if database_path.startswith('sqlite'):
+        return {}
+    # Imported here as metrics.py imports the models
+    from metrics import InstrumentedQueuePool
+    worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+    defaults = POOL_DEFAULTS.get(worker_class, POOL_DEFAULTS['sync'])
+    options = {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', defaults['pool_size'])),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', defaults['max_overflow'])),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 10)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true',
+    }
+    # psycopg2's executemany sends one INSERT per row, in 'values' mode the rows
+    # go out as multi-row INSERT ... VALUES statements (execute_values)
+    if make_url(database_path).get_dialect().driver == 'psycopg2':
+        options['executemany_mode'] = 'values'
+    return options
 
-db = SQLAlchemy()
 
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    DATABASE_URL is read here rather than at import, and no connection is
+    opened until the first query
+    read replicas get engines of their own, outside of the binds used by create_all
 '''
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=None):
+    database_path = database_path or os.environ['DATABASE_URL']
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
     db.app = app
     db.init_app(app)
-    migrate = Migrate(app, db)
+    urls = replica_urls(app)
+    if urls:
+        app.extensions['replicas'] = ReplicaSet([create_engine(url, **engine_options(url)) for url in urls])
+    else:
+        app.extensions.pop('replicas', None)
+
+
+'''
+enable_sqlite_foreign_keys
+    SQLite only enforces foreign keys, and so ON DELETE CASCADE, when asked to
+    per connection
+'''
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
+'''
+is_overlap(error)
+    whether an IntegrityError was raised by the booking non-overlap constraint
+'''
+def is_overlap(error):
+    return getattr(error.orig, 'pgcode', None) == EXCLUSION_VIOLATION
+
+
+'''
+default_end_time(context)
+    a booking without an end time lasts one session
+'''
+def default_end_time(context):
+    return context.get_current_parameters()['start_time'] + BOOKING_DURATION
 
 
 '''
@@ -29,22 +117,35 @@ class Therapist(db.Model):
 
   id = Column(db.Integer, primary_key=True)
   name = Column(db.String)
-  bookings = db.relationship('Booking', backref='therapist', lazy=True, cascade="all, delete")
+  # The database deletes the bookings of a therapist (ON DELETE CASCADE), they are never loaded for it
+  bookings = db.relationship('Booking', backref='therapist', lazy=True, cascade="all, delete", passive_deletes=True)
 
   def __init__(self, name):
     self.name = name
 
   def insert(self):
     db.session.add(self)
+    ListingVersion.bump('therapists')
     db.session.commit()
   
   def update(self):
+    ListingVersion.bump('therapists')
     db.session.commit()
 
   def delete(self):
     db.session.delete(self)
+    ListingVersion.bump('therapists')
     db.session.commit()
 
+  @classmethod
+  def delete_by_id(cls, therapist_id):
+    '''deletes a therapist and its bookings without loading them, returning whether it existed'''
+    deleted = cls.query.filter(cls.id == therapist_id).delete(synchronize_session=False)
+    if deleted:
+      ListingVersion.bump('therapists')
+    db.session.commit()
+    return bool(deleted)
+
 
   def format(self):
     return {
@@ -54,17 +155,46 @@ class Therapist(db.Model):
 
 '''
 Bookings
+    bookings of a therapist cannot overlap, enforced on PostgreSQL by the
+    ex_Booking_no_overlap exclusion constraint created in migration 2d8a6f4c0e13
+    and never longer than MAX_BOOKING_LENGTH (ck_Booking_max_length on PostgreSQL)
+    version is bumped by every update and serves as the ETag of a booking
 '''
 class Booking(db.Model):  
   __tablename__ = 'Booking'
+  __table_args__ = (
+    db.Index('ix_Booking_therapist_id_start_time', 'therapist_id', 'start_time'),
+    db.Index('ix_Booking_start_time_id', 'start_time', 'id'),
+    db.CheckConstraint('end_time > start_time', name='ck_Booking_end_after_start'),
+  )
 
   id = Column(db.Integer, primary_key=True)
-  therapist_id = db.Column(db.Integer, db.ForeignKey('Therapist.id'), nullable=False)
+  therapist_id = db.Column(db.Integer, db.ForeignKey('Therapist.id', ondelete='CASCADE'), nullable=False)
   start_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+  end_time = db.Column(db.DateTime, nullable=False, default=default_end_time)
+  version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
 
   def insert(self):
     db.session.add(self)
     db.session.commit()
+
+  @classmethod
+  def bulk_insert(cls, entries):
+    '''inserts a list of booking dicts in one transaction, setting their ids'''
+    if not entries:
+      return
+    if db.engine.dialect.name == 'postgresql':
+      # Reserve the ids up front so all rows go out as one executemany, which
+      # executemany_mode='values' (see engine_options) turns into multi-row INSERTs
+      ids = db.session.execute(
+        db.text("SELECT nextval(pg_get_serial_sequence('\"Booking\"', 'id')) FROM generate_series(1, :count)"),
+        {'count': len(entries)})
+      for entry, row in zip(entries, ids):
+        entry['id'] = row[0]
+      db.session.bulk_insert_mappings(cls, entries)
+    else:
+      db.session.bulk_insert_mappings(cls, entries, return_defaults=True)
+    db.session.commit()
   
   def update(self):
     db.session.commit()
@@ -73,10 +203,190 @@ class Booking(db.Model):
     db.session.delete(self)
     db.session.commit()
 
+  @classmethod
+  def update_if_match(cls, booking_id, changes_for, versions=None):
+    '''updates a booking if it is at one of versions (any version if None),
+    returning (found, row): whether the booking exists, and the updated row or
+    None if it does not or is at another version
+    changes_for(start_time, end_time) returns the new column values given the
+    current times. On PostgreSQL these are the columns themselves, so the check,
+    the update and reading the result back are one UPDATE ... RETURNING, joined
+    to a lookup of the id in the same statement to tell a missing booking apart
+    Elsewhere the row is read first and updated with a version check'''
+    try:
+      if db.engine.dialect.name == 'postgresql':
+        conditions = [cls.id == booking_id]
+        if versions is not None:
+          conditions.append(cls.version.in_(versions))
+        changes = dict(changes_for(cls.start_time, cls.end_time), version=cls.version + 1)
+        updated = cls.__table__.update().where(db.and_(*conditions)) \
+          .values(changes).returning(*cls.__table__.columns).cte('updated')
+        result = db.session.execute(cls.matched_statement(booking_id, updated)).first()
+        db.session.commit()
+        if result is None:
+          return False, None
+        return True, (result if result.id is not None else None)
+
+      booking = cls.query.get(booking_id)
+      if booking is None:
+        return False, None
+      if versions is not None and booking.version not in versions:
+        return True, None
+      changes = dict(changes_for(booking.start_time, booking.end_time), version=cls.version + 1)
+      updated = cls.query.filter(cls.id == booking_id, cls.version == booking.version) \
+        .update(changes, synchronize_session=False)
+      db.session.commit()
+      return True, (booking if updated else None)
+    except exc.IntegrityError:
+      db.session.rollback()
+      raise
+
+  @classmethod
+  def delete_by_id(cls, booking_id, versions=None):
+    '''deletes a booking if it is at one of versions (any version if None),
+    returning (found, deleted): whether the booking existed and whether it was deleted
+    On PostgreSQL this is a single DELETE ... RETURNING joined to a lookup of the id,
+    elsewhere the version is read first and the delete checks it'''
+    if db.engine.dialect.name == 'postgresql':
+      conditions = [cls.id == booking_id]
+      if versions is not None:
+        conditions.append(cls.version.in_(versions))
+      deleted = cls.__table__.delete().where(db.and_(*conditions)).returning(cls.id).cte('deleted')
+      result = db.session.execute(cls.matched_statement(booking_id, deleted)).first()
+      db.session.commit()
+      if result is None:
+        return False, False
+      return True, result.id is not None
+
+    version = db.session.query(cls.version).filter(cls.id == booking_id).scalar()
+    if version is None:
+      return False, False
+    if versions is not None and version not in versions:
+      return True, False
+    deleted = cls.query.filter(cls.id == booking_id, cls.version == version).delete(synchronize_session=False)
+    db.session.commit()
+    return True, bool(deleted)
+
+  @classmethod
+  def matched_statement(cls, booking_id, changed):
+    '''selects the rows RETURNING from a data modifying CTE next to whether the booking exists,
+    no row when it does not and NULL columns when it exists but was not changed
+    All parts of the statement see the same snapshot, so the lookup sees the row as it was'''
+    found = db.select([cls.id.label('found_id')]).where(cls.id == booking_id).cte('found')
+    return db.select([found.c.found_id] + list(changed.c)).select_from(found.outerjoin(changed, db.true()))
+
 
   def format(self):
     return {
       'id': self.id,
       'therapist_id': self.therapist_id,
-      'start_time': self.start_time
-      }
\ No newline at end of file
+      'start_time': self.start_time,
+      'end_time': self.end_time
+      }
+
+# The non-overlap constraint cannot be declared portably, create_all adds it on
+# PostgreSQL the same way as migration 2d8a6f4c0e13
+event.listen(Booking.__table__, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS btree_gist').execute_if(dialect='postgresql'))
+event.listen(Booking.__table__, 'after_create',
+             DDL('ALTER TABLE "Booking" ADD CONSTRAINT "ex_Booking_no_overlap" '
+                 'EXCLUDE USING gist (therapist_id WITH =, tsrange(start_time, end_time) WITH &&)').execute_if(dialect='postgresql'))
+# PATCH computes times in SQL on PostgreSQL, this bounds them like the checks of
+# booking_times, as in migration 6b9e2f4a8c17. SQLite has no interval arithmetic
+event.listen(Booking.__table__, 'after_create',
+             DDL('ALTER TABLE "Booking" ADD CONSTRAINT "ck_Booking_max_length" '
+                 "CHECK (end_time - start_time <= interval '{} seconds')".format(int(MAX_BOOKING_LENGTH.total_seconds())))
+             .execute_if(dialect='postgresql'))
+
+'''
+ListingVersion
+    a counter per cached listing, bumped in the same transaction as every write
+    to the listing so all workers see when their cached responses are stale
+'''
+class ListingVersion(db.Model):
+  __tablename__ = 'ListingVersion'
+
+  name = Column(db.String, primary_key=True)
+  version = Column(db.Integer, nullable=False, default=0)
+  updated_at = Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+  @classmethod
+  def current(cls, name):
+    '''returns the version and last modification time of a listing'''
+    row = db.session.query(cls.version, cls.updated_at).filter(cls.name == name).first()
+    if row is None:
+      return 0, None
+    return row.version, row.updated_at
+
+  @classmethod
+  def bump(cls, name):
+    '''increments the version of a listing, to be committed with the write'''
+    bumped = cls.query.filter(cls.name == name).update(
+      {'version': cls.version + 1, 'updated_at': datetime.utcnow()}, synchronize_session=False)
+    if not bumped:
+      db.session.add(cls(name=name, version=1, updated_at=datetime.utcnow()))
+
+'''
+IdempotencyKey
+    the response to a POST sent with an Idempotency-Key header, replayed when
+    the client retries with the same key (see idempotency.py)
+    status_code is NULL while the first request with the key is in flight
+'''
+class IdempotencyKey(db.Model):
+  __tablename__ = 'IdempotencyKey'
+
+  key = Column(db.String(64), primary_key=True)
+  request_hash = Column(db.String(64), nullable=False)
+  status_code = Column(db.Integer)
+  body = Column(db.LargeBinary)
+  created_at = Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+  @classmethod
+  def claim(cls, key, request_hash, ttl, pending_timeout, attempts=3):
+    '''claims a key for a request in any worker, returning (claimed_at, None) when this request got it,
+    or (None, row) with the response or the pending claim of the request that did
+    Keys older than ttl, and pending claims older than pending_timeout (left behind by a worker
+    that died), are taken over by a single conditional UPDATE, so only one request can win them'''
+    for attempt in range(attempts):
+      claimed_at = datetime.utcnow()
+      try:
+        db.session.execute(cls.__table__.insert().values(key=key, request_hash=request_hash, created_at=claimed_at))
+        db.session.commit()
+        return claimed_at, None
+      except exc.IntegrityError:
+        db.session.rollback()
+
+      taken_over = cls.query.filter(cls.key == key, db.or_(
+        cls.created_at < claimed_at - ttl,
+        db.and_(cls.status_code.is_(None), cls.created_at < claimed_at - pending_timeout))) \
+        .update({'request_hash': request_hash, 'status_code': None, 'body': None, 'created_at': claimed_at},
+                synchronize_session=False)
+      db.session.commit()
+      if taken_over:
+        return claimed_at, None
+      row = cls.query.get(key)
+      if row is not None:
+        return None, row
+      # Released by the other request in the meantime, claim it again
+    return None, cls(key=key, request_hash=request_hash)
+
+  @classmethod
+  def complete(cls, key, claimed_at, status_code, body):
+    '''stores the response of a claim, unless it was taken over'''
+    cls.query.filter(cls.key == key, cls.created_at == claimed_at).update(
+      {'status_code': status_code, 'body': body}, synchronize_session=False)
+    db.session.commit()
+
+  @classmethod
+  def release(cls, key, claimed_at):
+    '''forgets a pending claim so the request can be retried'''
+    db.session.rollback()
+    cls.query.filter(cls.key == key, cls.created_at == claimed_at).delete(synchronize_session=False)
+    db.session.commit()
+
+  @classmethod
+  def prune(cls, before):
+    '''deletes the keys created before a datetime, returning how many'''
+    count = cls.query.filter(cls.created_at < before).delete(synchronize_session=False)
+    db.session.commit()
+    return count
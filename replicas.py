@@ -0,0 +1,156 @@
+import os
+import time
+from itertools import count
+from flask import g, has_request_context, request
+from flask_sqlalchemy import BaseQuery, SQLAlchemy, SignallingSession
+from sqlalchemy import exc, orm
+from sqlalchemy.sql.dml import UpdateBase
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+# Clients that wrote read from the primary for this many seconds, covering replication lag
+REPLICA_STICKY_SECONDS = int(os.environ.get('DATABASE_REPLICA_STICKY_SECONDS', 5))
+PRIMARY_COOKIE = 'db_primary_until'
+# The same pin as a header, for API clients that do not keep cookies: they send
+# back the value of the last write response to read their own writes
+PRIMARY_HEADER = 'DB-Primary-Until'
+# Seconds a read replica that could not be connected to is skipped
+REPLICA_RETRY_INTERVAL = int(os.environ.get('DATABASE_REPLICA_RETRY_INTERVAL', 30))
+
+
+'''
+replica_urls(app)
+    the read replicas from app.config or the comma separated DATABASE_REPLICA_URLS
+'''
+def replica_urls(app):
+    urls = app.config.get('DATABASE_REPLICA_URLS', os.environ.get('DATABASE_REPLICA_URLS', ''))
+    if isinstance(urls, str):
+        urls = urls.split(',')
+    return [url.strip() for url in urls if url.strip()]
+
+
+'''
+ReplicaSet
+    the read replicas of an app, taken in turn
+    a replica that cannot be connected to is marked down and skipped for
+    retry_interval seconds, reads fall back to the primary when all are down
+'''
+class ReplicaSet:
+  def __init__(self, engines, retry_interval=REPLICA_RETRY_INTERVAL):
+    self.engines = engines
+    self.retry_interval = retry_interval
+    self.down_until = {}
+    self.turn = count()
+
+  def available(self):
+    '''yields the replicas not marked down, starting with the next in turn'''
+    start = next(self.turn)
+    now = time.monotonic()
+    for offset in range(len(self.engines)):
+      engine = self.engines[(start + offset) % len(self.engines)]
+      if self.down_until.get(engine, 0) <= now:
+        yield engine
+
+  def choose(self):
+    '''returns the next replica not marked down, or None, without connecting to it'''
+    return next(self.available(), None)
+
+  def mark_down(self, engine):
+    self.down_until[engine] = time.monotonic() + self.retry_interval
+
+  def for_request(self):
+    '''the replica serving the reads of the current request, chosen once per request'''
+    if 'db_replica' not in g:
+      g.db_replica = self.choose()
+    return g.db_replica
+
+
+'''
+RoutingSession
+    sends the reads of requests marked read only (see route_reads) to a
+    replica, flushes and INSERT/UPDATE/DELETE statements always go to the primary
+'''
+class RoutingSession(SignallingSession):
+  def get_bind(self, mapper=None, clause=None):
+    replicas = self.app.extensions.get('replicas')
+    if (replicas and not self._flushing and not isinstance(clause, UpdateBase)
+        and has_request_context() and g.get('db_read_only')):
+      engine = replicas.for_request()
+      if engine is not None:
+        return engine
+    return super().get_bind(mapper, clause)
+
+  def on_replica(self):
+    return has_request_context() and g.get('db_read_only') and g.get('db_replica') is not None
+
+  def fall_back_to_primary(self):
+    '''marks the replica of the request down and sends its remaining reads to the primary'''
+    self.app.extensions['replicas'].mark_down(g.db_replica)
+    g.db_replica = None
+    self.rollback()
+
+  def execute(self, clause, params=None, mapper=None, bind=None, **kw):
+    try:
+      return super().execute(clause, params, mapper, bind, **kw)
+    except exc.OperationalError:
+      if bind is not None or not self.on_replica():
+        raise
+      self.fall_back_to_primary()
+      return super().execute(clause, params, mapper, bind, **kw)
+
+
+'''
+RoutingQuery
+    runs again on the primary when the replica it was sent to fails, whether
+    it cannot be connected to or the connection breaks during the query
+'''
+class RoutingQuery(BaseQuery):
+  def __iter__(self):
+    try:
+      return super().__iter__()
+    except exc.OperationalError:
+      if not self.session.on_replica():
+        raise
+      self.session.fall_back_to_primary()
+      return super().__iter__()
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+  def create_session(self, options):
+    return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def pinned_to_primary():
+  """Whether the client wrote recently enough that replicas may not have its write yet"""
+  for pin in (request.cookies.get(PRIMARY_COOKIE), request.headers.get(PRIMARY_HEADER)):
+    try:
+      if pin and float(pin) > time.time():
+        return True
+    except ValueError:
+      pass
+  return False
+
+
+def route_reads():
+  g.db_read_only = request.method in SAFE_METHODS and not pinned_to_primary()
+
+
+def pin_writes(response):
+  """Successful writes pin the reads of the client to the primary for a while"""
+  if request.method not in SAFE_METHODS and response.status_code < 400:
+    pinned_until = str(time.time() + REPLICA_STICKY_SECONDS)
+    response.set_cookie(PRIMARY_COOKIE, pinned_until,
+                        max_age=REPLICA_STICKY_SECONDS, httponly=True, samesite='Lax')
+    response.headers[PRIMARY_HEADER] = pinned_until
+  return response
+
+
+def setup_replicas(app):
+  ''' Routes the queries of GET requests to the read replicas configured for setup_db
+  Writes, and reads by a client for REPLICA_STICKY_SECONDS after its last write, use the primary
+  The pin is a cookie, and a header for clients that drop cookies (most bearer token API clients)
+  Nothing is hooked without replicas
+  '''
+  if not replica_urls(app):
+    return
+  app.before_request(route_reads)
+  app.after_request(pin_writes)
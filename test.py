@@ -1,21 +1,65 @@
 import unittest
 import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import io
+from unittest import mock
+from datetime import datetime, timedelta
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine
+
+from app import create_app, therapist_bookings_query, list_query
+import metrics
+from replicas import PRIMARY_COOKIE, PRIMARY_HEADER
+from transfer import export_rows, import_rows
+from models import setup_db, db, Therapist, Booking, IdempotencyKey
+from auth import JWKSCache, jwks_cache
+from cache import LRUCache
+from availability import free_slots, busy_query
+from benchmarks.fixtures import token, write_jwks
+
+admin_headers = therapist_headers = None
+
+def prompt_tokens():
+    """Asks for the Auth0 tokens of the test cases run against the live tenant, once"""
+    global admin_headers, therapist_headers
+    if admin_headers is not None:
+        return
+    print("Enter an admin authentication token;")
+    admin_headers={'Authorization': 'Bearer ' + input()}
+
+    print("Enter a therapist authentication token;")
+    therapist_headers={'Authorization': 'Bearer ' + input()}
+
+
+class LocalTokens:
+    """Mixin verifying tokens against the local signing key of benchmarks/fixtures.py,
+    so the test case runs without Auth0 or network access"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.jwks_directory = tempfile.TemporaryDirectory()
+        cls.saved_jwks = (jwks_cache.url, jwks_cache.keys, jwks_cache.fetched_at, jwks_cache.last_attempt)
+        jwks_cache.url = write_jwks(os.path.join(cls.jwks_directory.name, 'jwks.json'))
+        jwks_cache.keys, jwks_cache.fetched_at, jwks_cache.last_attempt = {}, None, None
+        cls.admin_headers = {'Authorization': 'Bearer ' + token()}
+
+    @classmethod
+    def tearDownClass(cls):
+        jwks_cache.url, jwks_cache.keys, jwks_cache.fetched_at, jwks_cache.last_attempt = cls.saved_jwks
+        cls.jwks_directory.cleanup()
 
-from app import create_app
-from models import setup_db, Therapist, Booking
-
-print("Enter an admin authentication token;")
-admin_token='Bearer ' + input()
-admin_headers={'Authorization': admin_token}
-
-print("Enter a therapist authentication token;")
-therapist_token='Bearer ' + input()
-therapist_headers={'Authorization': therapist_token}
 
 class BookingTestCase(unittest.TestCase):
     """This class represents the booking test case"""
 
+    @classmethod
+    def setUpClass(cls):
+        prompt_tokens()
+
     def setUp(self):
         """Define test variables and initialize app."""
         self.app = create_app()
@@ -59,6 +103,78 @@ class BookingTestCase(unittest.TestCase):
         # Check data
         self.assertTrue(len(data['therapists']))
 
+    def test_get_therapists_page_not_found(self):
+        """Test that a page past the last therapist is not found"""
+
+        res = self.client().get('/therapists?page=100000')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_get_therapists_cursor_pages(self):
+        """Test that following next_cursor never returns a therapist twice"""
+
+        seen = []
+        cursor = None
+        while True:
+            url = '/therapists?limit=2' + ('&after=' + cursor if cursor else '')
+            res = self.client().get(url)
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            seen += [therapist['id'] for therapist in data['therapists']]
+            cursor = data['next_cursor']
+            if not cursor:
+                break
+
+        self.assertEqual(seen, sorted(set(seen)))
+
+    def test_get_therapists_cursor_malformed(self):
+        """Test that a malformed cursor is a bad request"""
+
+        res = self.client().get('/therapists?after=not-a-cursor')
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_therapists_not_modified(self):
+        """Test that the therapists listing revalidates with its ETag until a therapist is created"""
+
+        res = self.client().get('/therapists')
+        etag = res.headers['ETag']
+
+        res = self.client().get('/therapists', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+
+        res = self.client().post('/therapists', json=self.example_therapist,headers=admin_headers)
+        therapist_id = json.loads(res.data)['created']
+
+        res = self.client().get('/therapists', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+        self.client().delete('/therapists/'+str(therapist_id),headers=admin_headers)
+
+    def test_server_timing_header(self):
+        """Test that an instrumented app reports its query and auth timings"""
+
+        client = create_app({'INSTRUMENTATION': True}).test_client()
+        res = client.get('/bookings',headers=therapist_headers)
+
+        self.assertIn('db;dur=', res.headers['Server-Timing'])
+        self.assertIn('auth;dur=', res.headers['Server-Timing'])
+        self.assertNotIn('Server-Timing', self.client().get('/bookings',headers=therapist_headers).headers)
+
+    def test_metrics_count_routes(self):
+        """Test that requests and auth failures are exported per route template"""
+
+        self.client().get('/bookings')
+        res = self.client().get('/metrics')
+        body = res.data.decode()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('capstone_http_requests_total{method="GET",route="/bookings",status="401"}', body)
+        self.assertIn('capstone_auth_errors_total{code="authorization_header_missing"}', body)
+        self.assertIn('capstone_db_pool_checkouts', body)
+
     def test_get_bookings_unauthenticated(self):
         """ Test to see that we cannot access bookings page unauthenticated"""
         res = self.client().get('/bookings')
@@ -78,6 +194,43 @@ class BookingTestCase(unittest.TestCase):
         self.assertTrue(data['total_bookings'])
         self.assertTrue(len(data['bookings'])<=data['total_bookings'])
 
+    def test_get_bookings_filtered_and_sorted(self):
+        """Test that bookings can be filtered by therapist and start time and sorted by start time"""
+
+        booking = Booking.query.first()
+        res = self.client().get('/bookings?therapist_id={}&from=2000-01-01T00:00:00&sort=-start_time'.format(booking.therapist_id),headers=therapist_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(all(entry['therapist_id'] == booking.therapist_id for entry in data['bookings']))
+        start_times = [entry['start_time'] for entry in data['bookings']]
+        self.assertEqual(start_times, sorted(start_times, reverse=True))
+        self.assertEqual(data['total_bookings'], Booking.query.filter(Booking.therapist_id == booking.therapist_id, Booking.start_time >= datetime(2000, 1, 1)).count())
+        self.assertEqual(self.client().get('/bookings?sort=name',headers=therapist_headers).status_code, 400)
+
+    def test_get_bookings_by_ids(self):
+        """Test that a batch of bookings is returned keyed by id with the missing ids"""
+
+        booking_id = Booking.query.first().id
+        res = self.client().get('/bookings?ids={},0'.format(booking_id),headers=therapist_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['bookings'][str(booking_id)]['id'], booking_id)
+        self.assertEqual(data['missing'], [0])
+        res = self.client().get('/bookings?ids=' + ','.join(str(i) for i in range(101)),headers=therapist_headers)
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_bookings_stream_ndjson(self):
+        """Test that streamed bookings come back as one JSON object per line"""
+
+        res = self.client().get('/bookings?stream=ndjson',headers=therapist_headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+
+        bookings = [json.loads(line) for line in res.data.splitlines()]
+        self.assertTrue(all('start_time' in booking for booking in bookings))
+
     def test_get_therapists_not_found(self):
         """ Test what happens if we try to look for therapist that doesn't exist """
 
@@ -89,6 +242,34 @@ class BookingTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Resource Not Found')
 
+    def test_get_therapist_bookings_window(self):
+        """Test that bookings outside the requested time window are left out"""
+
+        res = self.client().post('/therapists', json=self.example_therapist,headers=admin_headers)
+        therapist_id = json.loads(res.data)['created']
+        self.client().post('/bookings', json={'therapist_id': therapist_id},headers=therapist_headers)
+
+        res = self.client().get('/therapists/'+str(therapist_id)+'?from=2100-01-01T00:00:00',headers=admin_headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['bookings'], [])
+
+        res = self.client().get('/therapists/'+str(therapist_id)+'?limit=1',headers=admin_headers)
+        data = json.loads(res.data)
+        self.assertEqual(len(data['bookings']), 1)
+        self.assertIsNone(data['next_cursor'])
+
+        self.client().post('/bookings', json={'therapist_id': therapist_id, 'start_time': '2099-01-01T09:00:00'},headers=therapist_headers)
+        res = self.client().get('/therapists/'+str(therapist_id)+'?limit=1',headers=admin_headers)
+        data = json.loads(res.data)
+        self.assertIsNotNone(data['next_cursor'])
+        res = self.client().get('/therapists/'+str(therapist_id)+'?limit=1&after='+data['next_cursor'],headers=admin_headers)
+        data = json.loads(res.data)
+        self.assertEqual(data['bookings'][0]['start_time'], '2099-01-01T09:00:00')
+        self.assertIsNone(data['next_cursor'])
+
+        self.client().delete('/therapists/'+str(therapist_id),headers=admin_headers)
+
     def test_delete_therapist_page_not_found(self):
         """Test what happens if we try to delete something that doesn't exist"""
         res = self.client().get('/therapists/9999',headers=admin_headers)
@@ -138,6 +319,21 @@ class BookingTestCase(unittest.TestCase):
         therapist = Therapist.query.filter(Therapist.id == therapist_id).one_or_none()
         self.assertEqual(therapist, None)
 
+    def test_delete_therapist_cascades_to_bookings(self):
+        """ Test that deleting a therapist deletes its bookings in the database """
+
+        res = self.client().post('/therapists', json=self.example_therapist,headers=admin_headers)
+        therapist_id = json.loads(res.data)['created']
+        res = self.client().post('/bookings', json={'therapist_id': therapist_id, 'start_time': '2031-03-04T09:00:00'},headers=admin_headers)
+        booking_id = json.loads(res.data)['created']
+
+        res_delete = self.client().delete('/therapists/'+str(therapist_id),headers=admin_headers)
+        self.assertEqual(res_delete.status_code, 200)
+
+        booking = Booking.query.filter(Booking.id == booking_id).one_or_none()
+        self.assertEqual(booking, None)
+        self.assertEqual(self.client().delete('/therapists/'+str(therapist_id),headers=admin_headers).status_code, 404)
+
     def test_create_therapist_fields_missing(self):
         res = self.client().post('/therapists', json="", headers=admin_headers)
         data = json.loads(res.data)
@@ -200,11 +396,502 @@ class BookingTestCase(unittest.TestCase):
         therapist = Booking.query.filter(Booking.id == booking_id).one_or_none()
         self.assertEqual(therapist, None)
 
+    def test_create_bookings_bulk(self):
+        """ Test that a bulk booking reports the result of every item """
+
+        res = self.client().post('/therapists', json=self.example_therapist,headers=admin_headers)
+        therapist_id = json.loads(res.data)['created']
+
+        bookings = [
+            {'therapist_id': therapist_id, 'start_time': '2021-08-02T09:00:00'},
+            {'therapist_id': 999999},
+            {'therapist_id': therapist_id, 'start_time': '2021-08-02T10:00:00'}
+        ]
+        res = self.client().post('/bookings/bulk', json=bookings,headers=therapist_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 2)
+        self.assertEqual([result['success'] for result in data['results']], [True, False, True])
+        self.assertEqual(data['results'][1]['error'], 422)
+
+        self.client().delete('/therapists/'+str(therapist_id),headers=admin_headers)
+
+    def test_create_bookings_bulk_overlaps(self):
+        """ Test that overlapping items of a bulk booking are reported and the others created """
+
+        res = self.client().post('/therapists', json=self.example_therapist,headers=admin_headers)
+        therapist_id = json.loads(res.data)['created']
+        self.client().post('/bookings', json={'therapist_id': therapist_id, 'start_time': '2021-08-03T09:00:00'},headers=therapist_headers)
+
+        bookings = [
+            {'therapist_id': therapist_id, 'start_time': '2021-08-03T09:30:00'},
+            {'therapist_id': therapist_id, 'start_time': '2021-08-03T11:00:00'},
+            {'therapist_id': therapist_id, 'start_time': '2021-08-03T11:30:00'}
+        ]
+        res = self.client().post('/bookings/bulk', json=bookings,headers=therapist_headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 1)
+        self.assertEqual([result.get('error') for result in data['results']], [409, None, 409])
+        self.assertEqual(data['results'][2]['message'], 'Overlaps item 1')
+
+        self.client().delete('/therapists/'+str(therapist_id),headers=admin_headers)
+
+    def test_create_booking_overlap_conflict(self):
+        """ Test that a therapist cannot be booked twice at the same time """
+
+        res = self.client().post('/therapists', json=self.example_therapist,headers=admin_headers)
+        therapist_id = json.loads(res.data)['created']
+
+        booking = {'therapist_id': therapist_id, 'start_time': '2021-08-02T09:00:00', 'duration': 60}
+        res = self.client().post('/bookings', json=booking,headers=therapist_headers)
+        self.assertEqual(res.status_code, 200)
+
+        overlapping = {'therapist_id': therapist_id, 'start_time': '2021-08-02T09:30:00', 'duration': 60}
+        res = self.client().post('/bookings', json=overlapping,headers=therapist_headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 409)
+        self.assertEqual(data['message'], 'Conflict')
+
+        self.client().delete('/therapists/'+str(therapist_id),headers=admin_headers)
+
+    def test_patch_booking_if_match(self):
+        """ Test that a PATCH with an outdated ETag is rejected """
+
+        res = self.client().post('/therapists', json=self.example_therapist,headers=admin_headers)
+        therapist_id = json.loads(res.data)['created']
+        res = self.client().post('/bookings', json={'therapist_id': therapist_id, 'start_time': '2031-05-06T09:00:00'},headers=therapist_headers)
+        booking_id = json.loads(res.data)['created']
+        etag = self.client().get('/bookings/'+str(booking_id),headers=therapist_headers).headers['ETag']
+
+        res = self.client().patch('/bookings/'+str(booking_id), json={'start_time': '2031-05-06T10:00:00'},headers=dict(therapist_headers, **{'If-Match': etag}))
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['end_time'], '2031-05-06T11:00:00')
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+        res = self.client().patch('/bookings/'+str(booking_id), json={'duration': 30},headers=dict(therapist_headers, **{'If-Match': etag}))
+        self.assertEqual(res.status_code, 412)
+        res = self.client().delete('/bookings/'+str(booking_id),headers=dict(therapist_headers, **{'If-Match': etag}))
+        self.assertEqual(res.status_code, 412)
+
+        self.client().delete('/therapists/'+str(therapist_id),headers=admin_headers)
+
+    def test_create_booking_times_out_of_range(self):
+        """ Test that times beyond the datetime range are rejected as unprocessable """
+
+        for booking in ({'therapist_id': 1, 'duration': 100000000000}, {'therapist_id': 1, 'start_time': '9999-12-31T23:30:00'}):
+            res = self.client().post('/bookings', json=booking,headers=therapist_headers)
+            self.assertEqual(res.status_code, 422)
+
+    def test_patch_booking_too_long(self):
+        """ Test that a PATCH cannot make a booking longer than MAX_BOOKING_LENGTH """
+
+        res = self.client().post('/therapists', json=self.example_therapist,headers=admin_headers)
+        therapist_id = json.loads(res.data)['created']
+        res = self.client().post('/bookings', json={'therapist_id': therapist_id, 'start_time': '2031-05-07T09:00:00'},headers=therapist_headers)
+        booking_id = json.loads(res.data)['created']
+
+        for changes in ({'duration': 100000}, {'end_time': '2031-05-28T09:00:00'}):
+            res = self.client().patch('/bookings/'+str(booking_id), json=changes,headers=therapist_headers)
+            self.assertEqual(res.status_code, 422)
+
+        self.client().delete('/therapists/'+str(therapist_id),headers=admin_headers)
+
     def test_delete_bookings_unauthenticated(self):
         """ Test to see that we cannot delete bookings when unauthenticated"""
         res = self.client().delete('/bookings/'+str(1))
         self.assertEqual(res.status_code, 401)
 
+
+class JWKSCacheTestCase(unittest.TestCase):
+    """This class represents the JWKS cache test case, run against a local JWKS file"""
+
+    def setUp(self):
+        self.jwks_file = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+        json.dump({'keys': [{'kty': 'RSA', 'kid': 'local', 'use': 'sig', 'n': 'AQAB', 'e': 'AQAB'}]}, self.jwks_file)
+        self.jwks_file.close()
+        self.cache = JWKSCache('file://' + self.jwks_file.name, ttl=600, min_refresh_interval=60)
+
+    def tearDown(self):
+        os.remove(self.jwks_file.name)
+
+    def test_known_kid_is_served_from_cache(self):
+        """Test that the JWKS is only fetched once for a known kid"""
+        self.assertEqual(self.cache.get_key('local')['kid'], 'local')
+        fetched_at = self.cache.fetched_at
+        self.assertEqual(self.cache.get_key('local')['kid'], 'local')
+        self.assertEqual(self.cache.fetched_at, fetched_at)
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        """Test that an unknown kid does not refetch more than once per interval"""
+        self.cache.get_key('local')
+        last_attempt = self.cache.last_attempt
+        self.assertEqual(self.cache.get_key('unknown'), None)
+        self.assertEqual(self.cache.last_attempt, last_attempt)
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    """This class represents the LRU cache used for verified tokens"""
+
+    def test_entries_expire_and_evict(self):
+        """Test that expired and least recently used entries are dropped"""
+        cache = LRUCache(maxsize=2)
+        cache.set('expired', {'sub': 'a'}, time.time() - 1)
+        cache.set('first', {'sub': 'b'}, time.time() + 60)
+        cache.set('second', {'sub': 'c'})
+        cache.set('third', {'sub': 'd'})
+
+        self.assertEqual(cache.get('expired'), None)
+        self.assertEqual(cache.get('first'), None)
+        self.assertEqual(cache.get('third'), {'sub': 'd'})
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+
+class FreeSlotsTestCase(unittest.TestCase):
+    """This class represents the free slot search between bookings"""
+
+    def test_gaps_between_overlapping_bookings(self):
+        """Test that overlapping bookings are merged and short gaps are left out"""
+        day = datetime(2021, 8, 2)
+        hour = timedelta(hours=1)
+        busy = [(day + 9 * hour, day + 10 * hour), (day + 9.5 * hour, day + 10.5 * hour), (day + 11 * hour, day + 12 * hour)]
+
+        slots = free_slots(busy, day + 8 * hour, day + 17 * hour, hour)
+
+        self.assertEqual(slots, [(day + 8 * hour, day + 9 * hour), (day + 12 * hour, day + 17 * hour)])
+
+class QueryPlanTestCase(unittest.TestCase):
+    """This class checks that the hot booking queries are served by indexes.
+    Runs against DATABASE_URL, a local PostgreSQL or a SQLite stand-in"""
+
+    def setUp(self):
+        self.app = create_app()
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.context.pop()
+
+    def explain(self, query):
+        """Returns the query plan of a query as text"""
+        statement = query.statement.compile(dialect=db.engine.dialect)
+        params = statement.params
+        if statement.positional:
+            params = tuple(params[name] for name in statement.positiontup)
+        connection = db.session.connection()
+        if db.engine.dialect.name == 'sqlite':
+            rows = connection.execute('EXPLAIN QUERY PLAN ' + str(statement), params)
+            return '\n'.join(str(row[-1]) for row in rows)
+        # Tiny test tables would otherwise always be scanned sequentially
+        connection.execute('SET LOCAL enable_seqscan = off')
+        rows = connection.execute('EXPLAIN ' + str(statement), params)
+        return '\n'.join(row[0] for row in rows)
+
+    def test_therapist_bookings_use_index(self):
+        """Test that the bookings of a therapist in a time window are looked up by index"""
+        plan = self.explain(therapist_bookings_query(1, datetime(2021, 1, 1), datetime(2021, 2, 1)))
+        self.assertIn('ix_Booking_therapist_id_start_time', plan)
+
+    def test_cascade_lookup_uses_index(self):
+        """Test that finding the bookings of a deleted therapist does not scan the table"""
+        plan = self.explain(Booking.query.filter(Booking.therapist_id == 1))
+        self.assertIn('ix_Booking_therapist_id_start_time', plan)
+
+    def test_busy_intervals_use_index(self):
+        """Test that the bookings overlapping an availability window are not found by a table scan"""
+        plan = self.explain(busy_query(datetime(2021, 1, 1), datetime(2021, 2, 1)))
+        self.assertRegex(plan, 'ix_Booking_start_time_id|ex_Booking_no_overlap')
+
+    def test_sorted_bookings_use_index(self):
+        """Test that bookings sorted by start time are read in index order, also past a cursor"""
+        query = list_query(Booking, sort='-start_time') \
+            .filter(db.tuple_(Booking.start_time, Booking.id) < db.tuple_(datetime(2021, 1, 1), 10)).limit(10)
+        self.assertIn('ix_Booking_start_time_id', self.explain(query))
+
+    def test_filtered_bookings_use_index(self):
+        """Test that the bookings of a therapist in a date range are looked up by index"""
+        filters = [Booking.therapist_id == 1, Booking.start_time >= datetime(2021, 1, 1), Booking.start_time < datetime(2021, 2, 1)]
+        plan = self.explain(list_query(Booking, filters, 'start_time'))
+        self.assertIn('ix_Booking_therapist_id_start_time', plan)
+
+class ReplicaRoutingTestCase(LocalTokens, unittest.TestCase):
+    """This class checks read replica routing, with two SQLite files standing in for the primary and a replica.
+    The primary and the replica each hold a different therapist, so responses show where they were read from"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.primary_path = 'sqlite:///' + os.path.join(self.directory.name, 'primary.db')
+        self.replica_path = 'sqlite:///' + os.path.join(self.directory.name, 'replica.db')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def make_app(self, replica_paths):
+        app = create_app({'DATABASE_REPLICA_URLS': replica_paths})
+        setup_db(app, self.primary_path)
+        with app.app_context():
+            db.create_all()
+            db.session.add(Therapist('primary'))
+            db.session.commit()
+        replica = create_engine(self.replica_path)
+        db.metadata.create_all(replica)
+        replica.execute(Therapist.__table__.insert(), name='replica')
+        return app
+
+    def therapist_names(self, client):
+        res = client.get('/therapists')
+        return [therapist['name'] for therapist in json.loads(res.data)['therapists']]
+
+    def test_reads_go_to_replica(self):
+        """Test that GET requests are served by the replica"""
+        client = self.make_app([self.replica_path]).test_client()
+        self.assertEqual(self.therapist_names(client), ['replica'])
+
+    def test_writes_pin_reads_to_primary(self):
+        """Test that a client reads from the primary after writing"""
+        client = self.make_app([self.replica_path]).test_client()
+
+        res = client.post('/therapists', json={'name': 'Tanner'}, headers=self.admin_headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(PRIMARY_COOKIE, res.headers['Set-Cookie'])
+        self.assertEqual(self.therapist_names(client), ['primary', 'Tanner'])
+
+    def test_header_pins_reads_of_cookieless_clients(self):
+        """Test that a client without cookies reads from the primary by sending back the pin header"""
+        app = self.make_app([self.replica_path])
+        res = app.test_client().post('/therapists', json={'name': 'Tanner'}, headers=self.admin_headers)
+
+        client = app.test_client(use_cookies=False)
+        self.assertEqual(self.therapist_names(client), ['replica'])
+        res = client.get('/therapists', headers={PRIMARY_HEADER: res.headers[PRIMARY_HEADER]})
+        self.assertEqual([therapist['name'] for therapist in json.loads(res.data)['therapists']], ['primary', 'Tanner'])
+
+    def test_unreachable_replica_falls_back_to_primary(self):
+        """Test that a replica that cannot be connected to is skipped"""
+        missing_path = 'sqlite:///' + os.path.join(self.directory.name, 'missing', 'replica.db')
+        app = self.make_app([missing_path])
+
+        self.assertEqual(self.therapist_names(app.test_client()), ['primary'])
+        self.assertEqual(len(app.extensions['replicas'].down_until), 1)
+
+    def test_failing_replica_query_falls_back_to_primary(self):
+        """Test that a query failing on a connected replica runs again on the primary"""
+        empty_path = 'sqlite:///' + os.path.join(self.directory.name, 'empty.db')
+        app = self.make_app([empty_path])
+
+        self.assertEqual(self.therapist_names(app.test_client()), ['primary'])
+        self.assertEqual(len(app.extensions['replicas'].down_until), 1)
+
+class IdempotencyTestCase(LocalTokens, unittest.TestCase):
+    """This class represents the Idempotency-Key handling of POST requests, run against a SQLite file"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = create_app()
+        setup_db(self.app, 'sqlite:///' + os.path.join(self.directory.name, 'test.db'))
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        self.context.pop()
+        self.directory.cleanup()
+
+    def post_therapist(self, body, key):
+        return self.client.post('/therapists', json=body, headers=dict(self.admin_headers, **{'Idempotency-Key': key}))
+
+    def test_retry_replays_response(self):
+        """Test that a retry gets the first response without creating another therapist"""
+        first = self.post_therapist({'name': 'Tanner'}, 'retry-key')
+        retry = self.post_therapist({'name': 'Tanner'}, 'retry-key')
+
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(json.loads(retry.data), json.loads(first.data))
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(Therapist.query.count(), 1)
+
+    def test_key_reused_for_other_body(self):
+        """Test that a key cannot be replayed for a different request"""
+        self.post_therapist({'name': 'Tanner'}, 'reused-key')
+        res = self.post_therapist({'name': 'Other'}, 'reused-key')
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(Therapist.query.count(), 1)
+
+    def test_failed_request_releases_key(self):
+        """Test that a request failing validation can be retried with the same key"""
+        self.assertEqual(self.post_therapist({}, 'failed-key').status_code, 422)
+        self.assertEqual(self.post_therapist({}, 'failed-key').status_code, 422)
+        self.assertEqual(IdempotencyKey.query.count(), 0)
+
+    def claim(self, key='a' * 64, ttl=timedelta(hours=1), pending_timeout=timedelta(minutes=1)):
+        return IdempotencyKey.claim(key, 'request', ttl, pending_timeout)
+
+    def test_concurrent_claim_loses(self):
+        """Test that only the first claim of a key succeeds and the second sees it pending"""
+        claimed_at, stored = self.claim()
+        self.assertIsNotNone(claimed_at)
+        claimed_at, pending = self.claim()
+        self.assertIsNone(claimed_at)
+        self.assertIsNone(pending.status_code)
+
+    def test_stale_claims_are_taken_over(self):
+        """Test that a claim left pending by a dead worker, or an expired key, can be claimed again"""
+        first_claim, _ = self.claim()
+        claimed_at, stored = self.claim(pending_timeout=timedelta(0))
+        self.assertIsNotNone(claimed_at)
+
+        IdempotencyKey.complete('a' * 64, claimed_at, 200, b'{}')
+        IdempotencyKey.complete('a' * 64, first_claim, 500, b'')
+        self.assertEqual(self.claim()[1].status_code, 200)
+        self.assertIsNotNone(self.claim(ttl=timedelta(0))[0])
+
+class MetricsAccessTestCase(unittest.TestCase):
+    """This class checks that the metrics endpoints only answer internal clients"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = create_app()
+        setup_db(self.app, 'sqlite:///' + os.path.join(self.directory.name, 'test.db'))
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_internal_clients_read_metrics(self):
+        """Test that loopback clients can read both metrics endpoints"""
+        for path in ('/metrics', '/metrics/pool'):
+            self.assertEqual(self.client.get(path).status_code, 200)
+
+    def test_external_clients_are_forbidden(self):
+        """Test that clients outside the allowed networks get 403"""
+        for path in ('/metrics', '/metrics/pool'):
+            for address in ('203.0.113.7', '10.1.2.3'):
+                res = self.client.get(path, environ_base={'REMOTE_ADDR': address})
+                self.assertEqual(res.status_code, 403)
+
+    def test_metrics_token(self):
+        """Test that external clients sending METRICS_TOKEN can read the metrics"""
+        external = {'REMOTE_ADDR': '203.0.113.7'}
+        with mock.patch.object(metrics, 'METRICS_TOKEN', 'scrape-secret'):
+            res = self.client.get('/metrics', environ_base=external, headers={'Authorization': 'Bearer scrape-secret'})
+            self.assertEqual(res.status_code, 200)
+            res = self.client.get('/metrics', environ_base=external, headers={'Authorization': 'Bearer wrong'})
+            self.assertEqual(res.status_code, 403)
+
+class TransferTestCase(unittest.TestCase):
+    """This class represents the bulk export and import of tables, run against a SQLite file"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = create_app()
+        setup_db(self.app, 'sqlite:///' + os.path.join(self.directory.name, 'test.db'))
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        self.context.pop()
+        self.directory.cleanup()
+
+    def reset(self):
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+
+    def booking_rows(self):
+        return db.session.query(Booking.id, Booking.therapist_id, Booking.start_time, Booking.end_time) \
+            .order_by(Booking.id).all()
+
+    def test_export_import_round_trip(self):
+        """Test that importing an export restores the same rows, in both formats"""
+        therapist = Therapist('Tanner')
+        therapist.insert()
+        start = datetime(2021, 8, 2, 9, 0, 0, 123456)
+        for hours in (0, 2):
+            Booking(therapist_id=therapist.id, start_time=start + timedelta(hours=hours),
+                    end_time=start + timedelta(hours=hours + 1)).insert()
+        therapists = [(therapist.id, 'Tanner')]
+        bookings = self.booking_rows()
+
+        for fmt in ('ndjson', 'csv'):
+            exported = {table: io.StringIO() for table in ('therapists', 'bookings')}
+            for table, out in exported.items():
+                export_rows(table, out, fmt)
+            self.reset()
+            for table in ('therapists', 'bookings'):
+                exported[table].seek(0)
+                self.assertGreater(import_rows(table, exported[table], fmt), 0)
+
+            self.assertEqual([(row.id, row.name) for row in Therapist.query.all()], therapists)
+            self.assertEqual(self.booking_rows(), bookings)
+
+    def test_import_without_ids_or_end_times(self):
+        """Test that imported bookings get ids and end times when the file has none, accepting a Z suffix"""
+        Therapist('Tanner').insert()
+        infile = io.StringIO(json.dumps({'therapist_id': 1, 'start_time': '2021-08-02T09:00:00Z'}) + '\n')
+
+        self.assertEqual(import_rows('bookings', infile), 1)
+        booking = Booking.query.one()
+        self.assertIsNotNone(booking.id)
+        self.assertEqual(booking.end_time, datetime(2021, 8, 2, 10, 0))
+
+    def test_import_converts_offsets_to_utc(self):
+        """Test that imported times with an offset are stored in UTC, like the API stores them"""
+        Therapist('Tanner').insert()
+        infile = io.StringIO(json.dumps({'therapist_id': 1, 'start_time': '2021-08-02T09:00:00+02:00'}) + '\n')
+
+        import_rows('bookings', infile)
+        booking = Booking.query.one()
+        self.assertEqual((booking.start_time, booking.end_time), (datetime(2021, 8, 2, 7, 0), datetime(2021, 8, 2, 8, 0)))
+
+class StartupTestCase(unittest.TestCase):
+    """This class checks the cold start of a worker against a time budget.
+    The budgets can be raised for slow machines with STARTUP_IMPORT_BUDGET_MS
+    and STARTUP_BUILD_BUDGET_MS"""
+
+    STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+built = 'app' in vars(app)
+app.app
+print(json.dumps({
+    'import_ms': 1000 * (imported - start),
+    'build_ms': 1000 * (time.perf_counter() - imported),
+    'built_on_import': built,
+    'flask_migrate': 'flask_migrate' in sys.modules,
+}))
+"""
+
+    def startup(self):
+        """Imports the app and builds it in a fresh interpreter, returning the timings"""
+        output = subprocess.check_output([sys.executable, '-c', self.STARTUP_SCRIPT],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        return json.loads(output)
+
+    def test_app_is_built_on_first_access(self):
+        """Test that importing app neither builds the app nor loads migrations"""
+        startup = self.startup()
+        self.assertFalse(startup['built_on_import'])
+        self.assertFalse(startup['flask_migrate'])
+
+    def test_startup_within_budget(self):
+        """Test that a worker can import and build the app within the startup budget"""
+        startup = self.startup()
+        self.assertLess(startup['import_ms'], float(os.environ.get('STARTUP_IMPORT_BUDGET_MS', 1000)))
+        self.assertLess(startup['build_ms'], float(os.environ.get('STARTUP_BUILD_BUDGET_MS', 250)))
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,142 @@
+import csv
+import io
+import json
+from datetime import datetime
+from itertools import islice
+
+from models import db, Therapist, Booking, ListingVersion, BOOKING_DURATION
+from serializers import parse_datetime
+
+BATCH_SIZE = 5000
+
+'''
+Tables that can be exported and imported, with the columns in file order
+'''
+TABLES = {
+  'therapists': (Therapist, ['id', 'name']),
+  'bookings': (Booking, ['id', 'therapist_id', 'start_time', 'end_time']),
+}
+FORMATS = ['ndjson', 'csv']
+
+
+def serialize_value(value):
+  """Datetimes are written as ISO-8601"""
+  if isinstance(value, datetime):
+    return value.isoformat()
+  return value
+
+
+def export_rows(table, out, fmt='ndjson', batch_size=BATCH_SIZE):
+  """Writes all rows of a table to out, streamed through a server-side cursor
+  so memory use does not depend on the size of the table. Returns the row count"""
+  model, columns = TABLES[table]
+  query = db.session.query(*[getattr(model, column) for column in columns]) \
+    .order_by(model.id) \
+    .yield_per(batch_size)
+
+  if fmt == 'csv':
+    writer = csv.writer(out)
+    writer.writerow(columns)
+  count = 0
+  for row in query:
+    values = [serialize_value(value) for value in row]
+    if fmt == 'csv':
+      writer.writerow(values)
+    else:
+      out.write(json.dumps(dict(zip(columns, values))) + '\n')
+    count += 1
+  return count
+
+
+def read_rows(infile, fmt, columns):
+  """Yields the rows of an NDJSON or CSV file as dicts"""
+  if fmt == 'csv':
+    for row in csv.DictReader(infile):
+      yield {column: row.get(column) or None for column in columns}
+  else:
+    for line in infile:
+      if line.strip():
+        row = json.loads(line)
+        yield {column: row.get(column) for column in columns}
+
+
+def fill_end_time(row):
+  """Bookings exported before they had an end time last one session"""
+  if row.get('end_time') is None and row.get('start_time') is not None:
+    row['end_time'] = (parse_datetime(row['start_time']) + BOOKING_DURATION).isoformat()
+  return row
+
+
+def convert_row(model, row):
+  """Converts the text values of a row to the python types of its columns"""
+  converted = {}
+  for column, value in row.items():
+    python_type = model.__table__.columns[column].type.python_type
+    if value is None or isinstance(value, python_type):
+      converted[column] = value
+    elif python_type is datetime:
+      converted[column] = parse_datetime(value)
+    else:
+      converted[column] = python_type(value)
+  return converted
+
+
+def copy_batch(model, columns, rows):
+  """Loads a batch of converted rows with PostgreSQL COPY. Rows without an id are copied
+  without the id column, so the sequence fills it in. The sequence is moved past the
+  imported ids first, so it does not hand out one of them"""
+  with_ids = [row for row in rows if row.get('id') is not None]
+  without_ids = [row for row in rows if row.get('id') is None]
+  if with_ids:
+    copy_rows(model, columns, with_ids)
+    advance_sequence(model)
+  if without_ids:
+    copy_rows(model, [column for column in columns if column != 'id'], without_ids)
+
+
+def copy_rows(model, columns, rows):
+  """Datetimes are written as ISO-8601 after conversion, so COPY stores the same
+  UTC values as the inserts of other databases"""
+  buffer = io.StringIO()
+  writer = csv.writer(buffer)
+  for row in rows:
+    writer.writerow([serialize_value(row.get(column)) for column in columns])
+  buffer.seek(0)
+  cursor = db.session.connection().connection.cursor()
+  cursor.copy_expert('COPY "{}" ({}) FROM STDIN WITH CSV'.format(
+    model.__tablename__, ', '.join('"{}"'.format(column) for column in columns)), buffer)
+
+
+def advance_sequence(model):
+  """Imported ids bypass the sequence, moves it past them"""
+  db.session.execute(db.text(
+    "SELECT setval(pg_get_serial_sequence(:table, 'id'), (SELECT MAX(id) FROM \"{}\"))".format(model.__tablename__)),
+    {'table': '"{}"'.format(model.__tablename__)})
+
+
+def import_rows(table, infile, fmt='ndjson', batch_size=BATCH_SIZE):
+  """Loads the rows of an NDJSON or CSV file into a table in batches,
+  using COPY on PostgreSQL and batched inserts elsewhere. Returns the row count"""
+  model, columns = TABLES[table]
+  postgresql = db.engine.dialect.name == 'postgresql'
+  rows = read_rows(infile, fmt, columns)
+  if table == 'bookings':
+    rows = (fill_end_time(row) for row in rows)
+  count = 0
+  while True:
+    batch = list(islice(rows, batch_size))
+    if not batch:
+      break
+    batch = [convert_row(model, row) for row in batch]
+    if postgresql:
+      copy_batch(model, columns, batch)
+    else:
+      db.session.execute(model.__table__.insert(), batch)
+    db.session.commit()
+    count += len(batch)
+
+  # Cached listings of the table are stale now
+  if count:
+    ListingVersion.bump(table)
+    db.session.commit()
+  return count